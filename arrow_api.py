@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+from backtesting import load_market_data
+from clearing import clear_bidding_curve
+from settlement import imbalance_errors, imbalance_cost
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Entry points for callers outside of Python (e.g. Julia through PyCall) exchanging plain arrays or Arrow tables
+# instead of pandas dataframes. pyarrow is only needed for the Arrow tables.
+
+
+def backtesting_arrays(region,
+                       datetimes,
+                       bid_prices,
+                       bid_volumes,
+                       production,
+                       one_price=False,
+                       optimal=False,
+                       update=True,
+                       producer=True,
+                       convert_to_utc=False):
+    # Function for simulating the market from plain arrays, with the same results as backtesting_function
+    # Example call: result = backtesting_arrays('SE1', datetimes, bid_prices, bid_volumes, production, update=False)
+    #
+    # ------ Required data structure --------
+    # datetimes is an array of datetime64 (or of int64 nanoseconds since 1970) with one value per hour,
+    # bid_prices and bid_volumes are 2-D arrays (hours, points) and production a 1-D array with one value per hour.
+    # When every hour has market data, float64 arrays in C or Fortran order (e.g. Julia matrices) are used without
+    # copying them, otherwise the rows of the hours with market data are copied.
+    # With convert_to_utc, the datetimes are in UTC. The time step of the datetimes (e.g. 15 minutes) is the settlement
+    # resolution, see load_market_data.
+    #
+    # ------ Output ----------
+    # A dict of contiguous 1-D arrays: Datetime (datetime64[ns]) and the columns of backtesting_function,
+    # for the hours with market data.
+    datetimes = pd.DatetimeIndex(np.asarray(datetimes).astype('datetime64[ns]'), name='Datetime')
+    if convert_to_utc:
+        datetimes = datetimes.tz_localize('UTC')
+    data = load_market_data(region, datetimes, update, convert_to_utc)
+    positions = datetimes.get_indexer(data.index)
+
+    bid_prices = np.asarray(bid_prices, dtype=np.float64)
+    bid_volumes = np.asarray(bid_volumes, dtype=np.float64)
+    production = np.asarray(production, dtype=np.float64)
+    if not (len(positions) == len(datetimes) and (positions == np.arange(len(positions))).all()):
+        bid_prices = bid_prices[positions]
+        bid_volumes = bid_volumes[positions]
+        production = production[positions]
+    spot_price = data['Spot_price'].to_numpy(dtype=np.float64)
+    volume = clear_bidding_curve(spot_price, bid_prices, bid_volumes, producer)
+    e_plus, e_minus = imbalance_errors(production, volume)
+    cost = imbalance_cost(spot_price,
+                          data['Upregulation_price'].to_numpy(dtype=np.float64),
+                          data['Downregulation_price'].to_numpy(dtype=np.float64),
+                          data['Dominating_direction'].to_numpy(),
+                          e_plus, e_minus, one_price)
+
+    result = {'Datetime': data.index.tz_localize(None).values.astype('datetime64[ns]') if convert_to_utc
+              else data.index.values.astype('datetime64[ns]')}
+    if optimal:
+        result['Imbalance_cost'] = cost
+        result['Profit'] = spot_price * volume + cost
+        result['Profit_no_error'] = production * spot_price
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['Optimization_ratio'] = result['Profit'] / result['Profit_no_error']
+    else:
+        result['Profit'] = spot_price * volume + cost
+        result['Imbalance_cost'] = cost
+    return result
+
+
+def backtesting_arrow(region,
+                      bidding_curve,
+                      production,
+                      one_price=False,
+                      optimal=False,
+                      update=True,
+                      producer=True,
+                      convert_to_utc=False):
+    # Function for simulating the market from Arrow tables, returning an Arrow table (requires pyarrow)
+    # Example call: table = backtesting_arrow('SE1', pyarrow.ipc.open_file(f).read_all(), production_table)
+    #
+    # ------ Required data structure --------
+    # bidding_curve is a table with a Datetime timestamp column and the bid_price_x and bid_volume_x columns of
+    # backtesting_function, production a table with Datetime and Production columns.
+    # The hours of the production are matched with the ones of the bidding curve.
+    #
+    # ------ Output ----------
+    # A table with a Datetime column and the columns of backtesting_function.
+    # The price and volume columns are copied into 2-D arrays, the production column is read without copying it
+    # when it has a single chunk and no missing value (see backtesting_arrays), and the output columns are not copied.
+    if pa is None:
+        raise ImportError('pyarrow is required for the Arrow tables, use backtesting_arrays with plain arrays')
+    datetimes = arrow_datetimes(bidding_curve.column('Datetime'))
+    price_cols = [name for name in bidding_curve.column_names if 'price' in name]
+    volume_cols = [name for name in bidding_curve.column_names if 'volume' in name]
+    bid_prices = np.column_stack([arrow_values(bidding_curve.column(name)) for name in price_cols])
+    bid_volumes = np.column_stack([arrow_values(bidding_curve.column(name)) for name in volume_cols])
+
+    production_datetimes = arrow_datetimes(production.column('Datetime'))
+    production_values = arrow_values(production.column('Production'))
+    if not np.array_equal(production_datetimes, datetimes):
+        positions = pd.DatetimeIndex(production_datetimes).get_indexer(datetimes)
+        production_values = np.where(positions < 0, np.nan, production_values[positions])
+
+    result = backtesting_arrays(region, datetimes, bid_prices, bid_volumes, production_values, one_price, optimal,
+                                update, producer, convert_to_utc)
+    names = list(result)
+    arrays = [pa.array(result['Datetime'], type=pa.timestamp('ns', tz='UTC' if convert_to_utc else None))] \
+             + [pa.array(result[name]) for name in names[1:]]
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def arrow_values(column):
+    # Float values of an Arrow column, as a numpy view of its buffer when it has a single chunk and no missing values
+    if column.null_count:
+        return column.to_numpy().astype(np.float64)
+    return np.asarray(column.to_numpy(), dtype=np.float64)
+
+
+def arrow_datetimes(column):
+    # Naive datetime64[ns] values of an Arrow timestamp column (UTC values for timezone-aware columns)
+    return np.asarray(column.to_numpy()).astype('datetime64[ns]')
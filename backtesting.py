@@ -1,17 +1,378 @@
 import os
 import json
+import hashlib
+import tempfile
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from datetime import timedelta
 import matplotlib.pyplot as plt
-from get_data import get_spot_prices, get_regulation_prices
+from get_data import update_prices, update_market_arrays, load_market_arrays, price_store_version
+from price_store import VALID_PRICES, VALID_DOMINATING_DIRECTION
 from wrapper_Ilias import wrapper_bidding_curve_Ilias, wrapper_production_Ilias
-from utils import cet_to_utc
+from utils import cet_to_utc, time_resolution, to_resolution, upsample
+from clearing import RaggedCurve, bidding_curve_arrays, clear_bidding_curve, select_ragged, clear_ragged_curve
+from settlement import imbalance_errors, imbalance_cost
+from profiling import profile_stage
+from parallel import RESULT_COLUMNS, SETTLED_COLUMN, shared_directory, remove_shared_directory, share_array, \
+    shared_result, settle_arrays, write_results
 
 file_dir = os.path.dirname(os.path.realpath(__file__))
 with open(file_dir + '/paths.json') as f:
     paths = json.load(f)
 
+# In-process LRU cache of the market data prepared by load_market_data, keyed by
+# (region, first date, last date, convert_to_utc, compact, float32_prices). The version of the price store is saved
+# with each entry, so that the entries are not used anymore once the local data has been updated.
+market_data_cache = OrderedDict()
+market_data_cache_size = 32
+market_data_cache_stats = {'hits': 0, 'misses': 0}
+
+def market_data_cache_info():
+    # Hit and miss counters of the market data cache, as well as its current and maximum sizes
+    return dict(market_data_cache_stats, size=len(market_data_cache), maxsize=market_data_cache_size)
+
+def clear_market_data_cache():
+    market_data_cache.clear()
+    market_data_cache_stats['hits'] = 0
+    market_data_cache_stats['misses'] = 0
+
+# LRU cache of the volumes cleared by cleared_volumes when memoize is set, keyed by a hash of the content of the
+# bidding curve, the cleared datetimes, the spot prices and the side, so that backtests only changing the settlement
+# or the production skip the clearing. The content hash of a whole curve is computed once per curve object
+# (see curve_fingerprint), so that a hit only hashes the spot prices and the datetimes.
+# Set cleared_volumes_cache_directory to a directory to also keep the volumes on disk (at most
+# cleared_volumes_disk_cache_size files, the oldest ones being removed), e.g. to share them between sessions.
+cleared_volumes_cache = OrderedDict()
+cleared_volumes_cache_size = 64
+cleared_volumes_cache_directory = None
+cleared_volumes_disk_cache_size = 1024
+cleared_volumes_cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+# Content hashes of the curves given to cleared_volumes, by identity of their objects while they are alive
+curve_fingerprints = {}
+
+def cleared_volumes_cache_info():
+    # Hit (in memory and on disk) and miss counters of the cleared volumes cache, as well as its current and maximum sizes
+    return dict(cleared_volumes_cache_stats, size=len(cleared_volumes_cache), maxsize=cleared_volumes_cache_size)
+
+def clear_cleared_volumes_cache(disk=False):
+    # Empty the cache in memory, and with disk the files of cleared_volumes_cache_directory too
+    cleared_volumes_cache.clear()
+    curve_fingerprints.clear()
+    for key in cleared_volumes_cache_stats:
+        cleared_volumes_cache_stats[key] = 0
+    if disk and cleared_volumes_cache_directory is not None and os.path.isdir(cleared_volumes_cache_directory):
+        for file_name in os.listdir(cleared_volumes_cache_directory):
+            if file_name.endswith('.npy'):
+                os.remove(os.path.join(cleared_volumes_cache_directory, file_name))
+
+def load_market_data(region,
+                     datetimes,
+                     update=True,
+                     convert_to_utc=False,
+                     profiler=None,
+                     compact=False,
+                     float32_prices=False,
+                     cache=True,
+                     resolution=None):
+    # Load the spot and regulation prices of a region for the given datetimes, merged in one dataframe
+    # and without the invalid values. The parameters have the same meaning as in backtesting_function.
+    # Example call: data = load_market_data('SE1', bidding_curve.index, update=False)
+    #
+    # The prepared data of the whole range of dates is cached (see market_data_cache_info), so that repeated
+    # calls for the same region and range only have to select the requested datetimes.
+    # Set cache to False to neither use nor fill the cache (e.g. for data read only once).
+    # resolution is the time unit of the settlement, by default the one of the datetimes: the prices are checked and
+    # resampled for it like in backtesting_function (see market_data_at_resolution).
+
+    if update:
+        with profile_stage(profiler, 'update_prices'):
+            update_prices(stream=True)
+    data = market_data_range(region, datetimes.min(), datetimes.max(), convert_to_utc, profiler, compact, float32_prices,
+                             cache)
+    data = market_data_at_resolution(region, data, time_resolution(datetimes) if resolution is None else resolution)
+    return select_datetimes(data, datetimes, profiler)
+
+def market_data_range(region, first_date, last_date, convert_to_utc=False, profiler=None, compact=False,
+                      float32_prices=False, cache=True):
+    # Prepared market data of a region for a whole range of datetimes (see prepare_market_data), from the cache
+    # when possible. The parameters have the same meaning as in load_market_data.
+    key = (region, first_date, last_date, convert_to_utc, compact, float32_prices)
+    version = price_store_version()
+    if cache and key in market_data_cache and market_data_cache[key][0] == version:
+        market_data_cache.move_to_end(key)
+        market_data_cache_stats['hits'] += 1
+        return market_data_cache[key][1]
+    if not cache:
+        return prepare_market_data(region, first_date, last_date, convert_to_utc, profiler, compact, float32_prices)
+    market_data_cache_stats['misses'] += 1
+    data = prepare_market_data(region, first_date, last_date, convert_to_utc, profiler, compact, float32_prices)
+    market_data_cache[key] = (version, data)
+    market_data_cache.move_to_end(key)
+    if len(market_data_cache) > market_data_cache_size:
+        market_data_cache.popitem(last=False)
+    return data
+
+def select_datetimes(data, datetimes, profiler=None):
+    # Filter out the data about the times which are not requested,
+    # with a binary search as the market data is sorted by datetime
+    with profile_stage(profiler, 'select_datetimes') as stage:
+        stage.rows = len(datetimes)
+        if not (data.index.is_monotonic_increasing and data.index.is_unique):
+            return data[data.index.isin(datetimes)]
+        market_datetimes = data.index.values
+        requested_datetimes = pd.DatetimeIndex(datetimes).values
+        positions = np.searchsorted(market_datetimes, requested_datetimes)
+        found = positions < len(market_datetimes)
+        found[found] = market_datetimes[positions[found]] == requested_datetimes[found]
+        return data.iloc[np.unique(positions[found])]
+
+def prepare_market_data(region, first_date, last_date, convert_to_utc=False, profiler=None, compact=False,
+                        float32_prices=False):
+    # Only read the region and the range of dates needed from the market arrays (already merged and deduplicated),
+    # with a margin of one day when the times are shifted by the UTC conversion
+    # In compact mode, Region and Unit are categorical columns, and the prices are float32 with float32_prices
+    # (see utils.compact_dtypes for the tolerance). The dominating direction is an int8 column, or a float column
+    # (float32 in compact mode) with nan for the hours without a known direction, which then have a nan imbalance cost.
+    with profile_stage(profiler, 'load_market_arrays') as stage:
+        arrays = load_market_arrays(region, first_date - timedelta(days=1), last_date + timedelta(days=1))
+        # Remove invalid values
+        valid = arrays['Validity'] & VALID_PRICES == VALID_PRICES
+        directions = arrays['Dominating_direction'][valid]
+        known_direction = arrays['Validity'][valid] & VALID_DOMINATING_DIRECTION > 0
+        if not known_direction.all():
+            directions = np.where(known_direction, directions, np.nan) \
+                .astype(np.float32 if compact or float32_prices else np.float64)
+        price_dtype = np.float32 if float32_prices else np.float64
+        if compact or float32_prices:
+            regions = pd.Categorical.from_codes(np.zeros(valid.sum(), dtype=np.int8), [region])
+            units = pd.Categorical(arrays['Unit'][valid])
+        else:
+            regions = region
+            units = arrays['Unit'][valid].astype(object)
+        data = pd.DataFrame({'Region': regions,
+                             'Unit': units,
+                             'Spot_price': arrays['Spot_price'][valid].astype(price_dtype, copy=False),
+                             'Downregulation_price': arrays['Downregulation_price'][valid].astype(price_dtype, copy=False),
+                             'Upregulation_price': arrays['Upregulation_price'][valid].astype(price_dtype, copy=False),
+                             'Dominating_direction': directions},
+                            index=pd.DatetimeIndex(arrays['Datetime'][valid], name='Datetime'))
+        stage.rows = len(valid)
+    if convert_to_utc:
+        with profile_stage(profiler, 'cet_to_utc') as stage:
+            stage.rows = len(data)
+            data = cet_to_utc(data, 'Datetime')
+    return data
+
+def simulate_market(region,
+                    bidding_curve,
+                    production,
+                    one_price=False,
+                    update=True,
+                    producer=True,
+                    convert_to_utc=False,
+                    verbose=False,
+                    profiler=None,
+                    compact=False,
+                    float32_prices=False,
+                    resolution=None,
+                    cache=True,
+                    memoize=False):
+    # Clear and settle every hour, and return the whole dataframe with the market data and the intermediate columns
+    # (Volume, Production, E+, E-, Imbalance_cost and Profit). The parameters are the ones of backtesting_function,
+    # cache is the one of load_market_data.
+
+    if update:
+        with profile_stage(profiler, 'update_prices'):
+            update_prices(stream=True)
+    market = market_data_range(region, bidding_curve.index.min(), bidding_curve.index.max(), convert_to_utc, profiler,
+                               compact, float32_prices, cache)
+    curve_resolution = time_resolution(bidding_curve.index)
+    resolution = curve_resolution if resolution is None else pd.Timedelta(resolution)
+    if curve_resolution < resolution:
+        raise ValueError('The settlement resolution ({0}) cannot be longer than the time unit of the bidding curve ({1})'
+                         .format(resolution, curve_resolution))
+    market = market_data_at_resolution(region, market, resolution)
+    data = select_datetimes(market, bidding_curve.index, profiler)
+    # Select upregulation or downregulation to remove duplicate index,
+    # and then merge with bidding curve and actual production
+    # The bidding curve is cleared for all the hours at once, see clear_bidding_curve for the interpolation formulas
+    with profile_stage(profiler, 'clearing') as stage:
+        stage.rows = len(data)
+        data['Volume'] = cleared_volumes(data, bidding_curve, producer, memoize)
+    if resolution < curve_resolution:
+        with profile_stage(profiler, 'resample') as stage:
+            stage.rows = len(data)
+            data = settlement_market_data(data, market, resolution, curve_resolution, profiler)
+            production = to_resolution(production, resolution, ['Production'])
+    if verbose:
+        print(production.head())
+    with profile_stage(profiler, 'merge_production') as stage:
+        stage.rows = len(data)
+        data = data.merge(production, left_index=True, right_index=True)
+    if verbose:
+        print(data.head())
+
+    with profile_stage(profiler, 'settlement') as stage:
+        stage.rows = len(data)
+        data = settle_market(data, one_price)
+    if verbose:
+        print(data[['Spot_price','Downregulation_price','Upregulation_price','Dominating_direction','Production','E+','E-','Imbalance_cost']])
+    return data
+
+def settlement_market_data(data, market, resolution, curve_resolution, profiler=None):
+    # Market data at the settlement resolution (e.g. 15 minutes), the volumes cleared for the periods of the bidding
+    # curve (e.g. hours) being spread evenly over the shorter settlement periods they contain.
+    # market is the market data of the whole range at the settlement resolution (see market_at_resolution).
+    volumes = upsample(data[['Spot_price', 'Volume']], resolution, curve_resolution, ['Volume'])
+    market = select_datetimes(market, volumes.index, profiler)
+    return market.drop(columns='Spot_price').join(volumes, how='inner')[list(data.columns)]
+
+def market_data_at_resolution(region, market, resolution):
+    # Market data of a whole range of dates ready to be settled at a resolution, the same way for all the backtests:
+    # a ValueError is raised when some prices are given for periods shorter than the resolution (only some of them
+    # would be used), and the hourly prices are used for all the periods of a resolution shorter than one hour
+    resolution = pd.Timedelta(resolution)
+    if finer_prices(market, resolution):
+        raise ValueError('Some prices of {0} are given for periods shorter than {1}, the backtest has to be settled '
+                         'at their resolution'.format(region, resolution))
+    if resolution < pd.Timedelta(hours=1):
+        market = market_at_resolution(market, resolution)
+    return market
+
+def finer_prices(market, resolution):
+    # Whether some rows of the market data are closer to each other than the resolution (e.g. 15-minute imbalance
+    # prices for hourly settlement), in which case settling at the resolution would only use some of them
+    periods = market.index.floor(resolution).values
+    return bool((periods[1:] == periods[:-1]).any())
+
+def market_at_resolution(market, resolution):
+    # Market data with one row per period of a resolution shorter than one hour (e.g. 15 minutes):
+    # the hours with a single row of prices from the start of the hour (the hourly prices of the older history)
+    # are split into periods of the resolution with the same prices
+    hours = market.index.floor('h')
+    hour_values = hours.values
+    single_row = np.ones(len(market), dtype=bool)
+    same_hour = hour_values[1:] == hour_values[:-1]
+    single_row[1:] &= ~same_hour
+    single_row[:-1] &= ~same_hour
+    hourly = single_row & (market.index == hours)
+    if not hourly.any():
+        return market
+    return pd.concat([market[~hourly], upsample(market[hourly], pd.Timedelta(resolution), pd.Timedelta(hours=1))]) \
+        .sort_index(kind='mergesort')
+
+def cleared_volumes(data, bidding_curve, producer=True, memoize=False):
+    # Cleared volumes of the bidding curve (wide dataframe or RaggedCurve) for the hours and spot prices of data
+    # With memoize, the volumes are kept in cleared_volumes_cache, and the curve must then not be modified in place
+    # (its content hash is only computed the first time, see curve_fingerprint).
+    spot_prices = np.ascontiguousarray(data['Spot_price'].to_numpy(dtype=np.float64))
+    if not memoize:
+        return clear_volumes(spot_prices, data.index, bidding_curve, producer)
+    key = content_hash([spot_prices, pd.DatetimeIndex(data.index).values.view(np.int64)],
+                       [curve_fingerprint(bidding_curve), producer])
+
+    if key in cleared_volumes_cache:
+        cleared_volumes_cache.move_to_end(key)
+        cleared_volumes_cache_stats['hits'] += 1
+        return cleared_volumes_cache[key]
+    file_name = None if cleared_volumes_cache_directory is None \
+        else os.path.join(cleared_volumes_cache_directory, key + '.npy')
+    if file_name is not None and os.path.exists(file_name):
+        cleared_volumes_cache_stats['disk_hits'] += 1
+        volumes = np.load(file_name)
+    else:
+        cleared_volumes_cache_stats['misses'] += 1
+        volumes = clear_volumes(spot_prices, data.index, bidding_curve, producer)
+        if file_name is not None:
+            save_cleared_volumes(file_name, volumes)
+    # The cached arrays are shared between the results, so they are read-only
+    volumes.setflags(write=False)
+    cleared_volumes_cache[key] = volumes
+    if len(cleared_volumes_cache) > cleared_volumes_cache_size:
+        cleared_volumes_cache.popitem(last=False)
+    return volumes
+
+def clear_volumes(spot_prices, index, bidding_curve, producer=True):
+    # Clear the rows of the bidding curve (wide dataframe or RaggedCurve) of the datetimes of index
+    if isinstance(bidding_curve, RaggedCurve):
+        return clear_ragged_curve(spot_prices, select_ragged(bidding_curve, index), producer)
+    bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve, index)
+    return clear_bidding_curve(spot_prices, bid_prices, bid_volumes, producer)
+
+def curve_fingerprint(bidding_curve):
+    # Content hash of a whole bidding curve (wide dataframe or RaggedCurve), computed once per curve object:
+    # it is kept in curve_fingerprints until the objects of the curve are garbage collected
+    owners = list(bidding_curve) if isinstance(bidding_curve, RaggedCurve) else [bidding_curve]
+    key = tuple(id(owner) for owner in owners)
+    if key in curve_fingerprints:
+        references, fingerprint = curve_fingerprints[key]
+        if all(reference() is owner for reference, owner in zip(references, owners)):
+            return fingerprint
+    datetimes = pd.DatetimeIndex(bidding_curve.index).values.view(np.int64)
+    if isinstance(bidding_curve, RaggedCurve):
+        fingerprint = content_hash([datetimes, bidding_curve.offsets, bidding_curve.prices, bidding_curve.volumes],
+                                   ['ragged'])
+    else:
+        fingerprint = content_hash([datetimes] + list(bidding_curve_arrays(bidding_curve)), ['wide'])
+    try:
+        references = [weakref.ref(owner, lambda _, key=key: curve_fingerprints.pop(key, None)) for owner in owners]
+    except TypeError:
+        # Objects without weak references (e.g. lists of prices) are hashed at every call
+        return fingerprint
+    curve_fingerprints[key] = (references, fingerprint)
+    return fingerprint
+
+def content_hash(arrays, flags=()):
+    # Hash of the shapes, dtypes and values of numpy arrays, and of a few flags
+    hasher = hashlib.sha1(repr([(array.shape, array.dtype.str) for array in arrays] + list(flags)).encode())
+    for array in arrays:
+        hasher.update(np.ascontiguousarray(array).view(np.uint8))
+    return hasher.hexdigest()
+
+def save_cleared_volumes(file_name, volumes):
+    # Write the volumes atomically to the disk cache, and remove the oldest files beyond its size
+    # The volumes are first written to a temporary file of a unique name not ending in .npy, so that other processes
+    # writing the same key do not share it, and that the eviction and clear_cleared_volumes_cache never see it.
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    file_descriptor, temporary_file_name = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(file_name))
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            np.save(f, volumes)
+        os.replace(temporary_file_name, file_name)
+    except BaseException:
+        os.remove(temporary_file_name)
+        raise
+    file_names = [os.path.join(cleared_volumes_cache_directory, name)
+                  for name in os.listdir(cleared_volumes_cache_directory) if name.endswith('.npy')]
+    if len(file_names) > cleared_volumes_disk_cache_size:
+        file_names.sort(key=os.path.getmtime)
+        for old_file_name in file_names[:len(file_names) - cleared_volumes_disk_cache_size]:
+            try:
+                os.remove(old_file_name)
+            except FileNotFoundError:
+                # Already removed by another process
+                pass
+
+def settle_market(data, one_price=False):
+    # Imbalance errors, imbalance costs and profits of the hours of the merged dataframe
+    # The equations of both price systems are the ones of settlement.imbalance_cost, shared with the other backtests.
+
+    # Calculate positive and negative errors
+    e_plus, e_minus = imbalance_errors(data['Production'].to_numpy(dtype=np.float64),
+                                       data['Volume'].to_numpy(dtype=np.float64))
+    data['E+'] = e_plus
+    data['E-'] = e_minus
+    data['Imbalance_cost'] = imbalance_cost(data['Spot_price'].to_numpy(dtype=np.float64),
+                                            data['Upregulation_price'].to_numpy(dtype=np.float64),
+                                            data['Downregulation_price'].to_numpy(dtype=np.float64),
+                                            data['Dominating_direction'].to_numpy(),
+                                            e_plus, e_minus, one_price)
+    data['Profit'] = data['Spot_price'] * data['Volume'] + data['Imbalance_cost']
+    return data
+
 def backtesting_function(region,
                          bidding_curve,
                          production,
@@ -20,7 +381,12 @@ def backtesting_function(region,
                          update=True,
                          producer=True,
                          convert_to_utc=False,
-                         verbose=False):
+                         verbose=False,
+                         profiler=None,
+                         compact=False,
+                         float32_prices=False,
+                         resolution=None,
+                         memoize=False):
     # Function for simulating the market and output the profit you would have made, as well as the imbalance costs.
 
     # ------ Required data structure --------
@@ -28,8 +394,9 @@ def backtesting_function(region,
     # (sorted in increasing order), one column called bid_price_x for the price and one column called bid_vol_x for the volume.
     # NB: The bid prices should be strictly monotonically increasing and the bid volumes should be monotonically increasing.
     # The unit for the volumes (both for bidding curve and production) should be MWh and prices should be €/MWh.
-    # As of now, this function does not support bidding_curves with variable number of points, this number must be
-    # coherent throughout the whole dataset.
+    # The wide dataframe needs the same number of points for every hour. Bidding curves with a variable number of points
+    # can be given as a clearing.RaggedCurve instead (flat arrays of prices and volumes with the offsets of every hour,
+    # see clearing.to_ragged and clearing.from_ragged to convert from and to the wide dataframe).
 
     # The bidding curve as well as the production should be pandas dataframes with pandas Datetime indices.
     # They should have the following content:
@@ -81,141 +448,540 @@ def backtesting_function(region,
     # The production parameter allows you to specify if you want the calculations to be made on the producer side
     # or on the retailer side.
 
+    # The profiler parameter takes a profiling.StageProfiler, which records the wall time, rows processed and peak memory
+    # of every stage (price loading, UTC conversion, filtering, clearing, merging and settlement) over all the calls
+    # made with it. Nothing is measured by default.
+
+    # The compact parameter loads the prices with categorical Region and Unit columns to save memory on long histories.
+    # float32_prices also stores the prices and returns the results as float32 (prices within 6e-8 relative error,
+    # see utils.compact_dtypes), the cleared volumes and the settlement being still computed in float64.
+
+    # The resolution parameter sets the time unit of the imbalance settlement (e.g. '15min'), by default the one of the
+    # bidding curve. The curve is cleared for its own periods (e.g. hourly spot prices), the cleared volumes are spread
+    # evenly over the settlement periods, and the production is resampled to them (split evenly or summed), so that
+    # the production can be given at either resolution. The output then has one row per settlement period.
+    # The hours with hourly prices only (e.g. the older history) use the same prices for all their settlement periods.
+    # A ValueError is raised when some prices are given for periods shorter than the settlement resolution.
+
+    # The memoize parameter keeps the cleared volumes in memory (see cleared_volumes_cache_info), so that backtests of
+    # the same bidding curve object only changing the settlement or the production skip the clearing.
+    # The bidding curve must then not be modified in place between the calls.
+
     # ------- Usage example -------------
     # bidding_curve = wrapper_bidding_curve_Ilias('day_1_2017.npz')
     # production = wrapper_production_Ilias('day_1_2017.npz')
     # result = backtesting_function('SE1', bidding_curve, production, False, False, False, False)
 
-    if update:
-        spot_prices = get_spot_prices()
-        regulation_prices = get_regulation_prices()
+    data = simulate_market(region, bidding_curve, production, one_price, update, producer, convert_to_utc, verbose,
+                           profiler, compact, float32_prices, resolution, memoize=memoize)
+    with profile_stage(profiler, 'output') as stage:
+        stage.rows = len(data)
+        if optimal:
+            data['Profit_no_error'] = data['Production'] * data['Spot_price']
+            data['Optimization_ratio'] = data['Profit']/data['Profit_no_error']
+            result = data[['Imbalance_cost','Profit','Profit_no_error','Optimization_ratio']]
+        else:
+            result = data[['Profit','Imbalance_cost']]
+        if float32_prices:
+            result = result.astype(np.float32)
+        return result
+
+
+def scenario_items(scenarios, index=None):
+    # Normalize a stack of scenarios to a list of (name, pandas object) pairs.
+    # Scenarios can be given as a single dataframe, a dict or a list of dataframes, or as a numpy array with the
+    # scenarios along the first axis and the hours along the second one (index then gives the datetimes of the hours).
+    if isinstance(scenarios, (pd.DataFrame, pd.Series)):
+        return [(0, scenarios)]
+    if isinstance(scenarios, dict):
+        return list(scenarios.items())
+    if isinstance(scenarios, np.ndarray):
+        if index is None:
+            raise ValueError('The datetimes of the hours must be provided as index when the scenarios are numpy arrays')
+        return [(i, scenario) for i, scenario in enumerate(scenarios)]
+    return list(enumerate(scenarios))
+
+
+def backtesting_batch(region,
+                      bidding_curves,
+                      productions,
+                      one_price=False,
+                      optimal=False,
+                      update=True,
+                      producer=True,
+                      convert_to_utc=False,
+                      index=None):
+    # Function for simulating the market for many scenarios (bidding curves and/or productions) at once.
+    # The market data is loaded once and all the scenarios are cleared and settled in the same vectorized pass.
+    #
+    # ------ Required data structure --------
+    # bidding_curves can be a single bidding curve (see backtesting_function for the structure), a dict or a list
+    # of bidding curves, or a 3-D numpy array (scenarios, hours, columns) with the columns in the order
+    # bid_price_1, bid_volume_1, bid_price_2, bid_volume_2, ...
+    # productions can be a single production dataframe, a dict or a list of them (dataframes with a Production
+    # column or series), or a 2-D numpy array (scenarios, hours).
+    # index gives the datetimes of the hours when numpy arrays are provided.
+    # If there are several bidding curves and several productions, they are paired in order (or by key for dicts),
+    # if only one of them has several scenarios, the other one is used for all the scenarios.
+    #
+    # ------ Parameters description ----------
+    # The other parameters have the same meaning as in backtesting_function, the settlement resolution being the time
+    # unit of the bidding curves (see load_market_data).
+    #
+    # ------ Output ----------
+    # A single dataframe indexed by (Scenario, Datetime), with the same columns as backtesting_function.
+    # Hours missing from the bidding curve or the production of a scenario are not included for this scenario.
+    #
+    # ------- Usage example -------------
+    # bidding_curves = {'base': wrapper_bidding_curve_Ilias('day_1_2017.npz'), 'shifted': shifted_bidding_curve}
+    # production = wrapper_production_Ilias('day_1_2017.npz')
+    # result = backtesting_batch('SE1', bidding_curves, production, update=False)
+    # result.groupby(level='Scenario').sum()
+
+    curves = scenario_items(bidding_curves, index)
+    prods = scenario_items(productions, index)
+    if len(curves) > 1 and len(prods) > 1:
+        if len(curves) != len(prods):
+            raise ValueError('Got {0} bidding curves for {1} productions'.format(len(curves), len(prods)))
+        if isinstance(bidding_curves, dict) and isinstance(productions, dict):
+            prods = [(name, productions[name]) for name, _ in curves]
+    names = [name for name, _ in (curves if len(curves) >= len(prods) else prods)]
+
+    if isinstance(bidding_curves, np.ndarray):
+        datetimes = pd.DatetimeIndex(index)
     else:
-        spot_prices = pd.read_csv(paths['data_directory'] + '/' + paths['spot_prices_file_name'],
-                                  parse_dates=True, index_col=0)
-        regulation_prices = pd.read_csv(paths['data_directory'] + '/' + paths['regulation_prices_file_name'],
-                                        parse_dates=True, index_col=0)
+        datetimes = curves[0][1].index
+        for _, bidding_curve in curves[1:]:
+            datetimes = datetimes.union(bidding_curve.index)
+    data = load_market_data(region, datetimes, update, convert_to_utc)
 
+    # Align all the scenarios on the market data, with nan for the missing hours
+    if isinstance(bidding_curves, np.ndarray):
+        positions = pd.DatetimeIndex(index).get_indexer(data.index)
+        missing = (positions < 0)[:, np.newaxis]
+        bid_prices = np.where(missing, np.nan, bidding_curves[:, positions, 0::2].astype(np.float64))
+        bid_volumes = np.where(missing, np.nan, bidding_curves[:, positions, 1::2].astype(np.float64))
+    else:
+        arrays = [bidding_curve_arrays(bidding_curve.reindex(data.index)) for _, bidding_curve in curves]
+        # Curves with fewer points than the others are padded with nan, which clear_bidding_curve skips
+        n_points = max(prices.shape[1] for prices, _ in arrays)
+        bid_prices = np.full((len(arrays), len(data), n_points), np.nan)
+        bid_volumes = np.full((len(arrays), len(data), n_points), np.nan)
+        for i, (prices, volumes) in enumerate(arrays):
+            bid_prices[i, :, :prices.shape[1]] = prices
+            bid_volumes[i, :, :volumes.shape[1]] = volumes
+    if isinstance(productions, np.ndarray):
+        positions = pd.DatetimeIndex(index).get_indexer(data.index)
+        production = np.where(positions < 0, np.nan, productions[:, positions].astype(np.float64))
+    else:
+        production = np.stack([(prod['Production'] if isinstance(prod, pd.DataFrame) else prod)
+                               .reindex(data.index).to_numpy(dtype=np.float64) for _, prod in prods])
 
-    spot_prices.index.name = 'Datetime'
-    regulation_prices.index.name = 'Datetime'
-    if convert_to_utc:
-        spot_prices = cet_to_utc(spot_prices, 'Datetime')
-        regulation_prices = cet_to_utc(regulation_prices, 'Datetime')
-    # Filter out the data about the times which are not present in the bidding curve
-    spot_prices = spot_prices[spot_prices.index.isin(bidding_curve.index)]
-    regulation_prices = regulation_prices[regulation_prices.index.isin(bidding_curve.index)]
-    spot_prices = spot_prices[spot_prices['Region'] == region]
-    regulation_prices = regulation_prices[regulation_prices['Region'] == region]
-    # Sometimes the most recent ref time will have duplicates for some reason, make sure to drop them
-    regulation_prices = regulation_prices[~regulation_prices.index.duplicated(keep='first')]
-    spot_prices = spot_prices[~spot_prices.index.duplicated(keep='first')]
-    data = spot_prices.merge(regulation_prices, left_on=['Datetime', 'Region', 'Unit'], right_on=['Datetime', 'Region', 'Unit'])
-    # Remove invalid values
-    data = data[data['Spot_price'] != -1]
-    data = data[data['Upregulation_price'] != -1]
-    data = data[data['Downregulation_price'] != -1]
-    # Select upregulation or downregulation to remove duplicate index,
-    # and then merge with bidding curve and actual production
-    bidding_price_cols = [col_name for col_name in bidding_curve.columns if 'price' in col_name]
-    bidding_vol_cols = [col_name for col_name in bidding_curve.columns if 'volume' in col_name]
-
-
-    bid_price_volumes = []
-    for idx, row in data.iterrows():
-        if producer:
-
-            # If x is the volume we are trying to determine, x1 the bid volume directly smaller, x2 directly larger,
-            # y being the spot price, y1 the bid price directly smaller and y2 directly larger,
-            # then x = x2 - (y2 - y)/(y2-y1)*(x2-x1)
-            # Here, we are trying to find the column containing y2, and then finding all the other values from their relative
-            # position to y2 in the dataframe.
-            # The prices/volumes are supposed to be sorted in the increasing order,
-            # the bid price/volume columns supposed to be directly next one to another for a specific one,
-            # and the first column is supposed to be the first bid price (followed by the first bid volume etc).
-
-            bidding_curve_row = bidding_curve.loc[idx]
-            # If spot price is above biggest bidding price, assign biggest bidding volume
-            if row['Spot_price'] > bidding_curve_row[bidding_price_cols[-1]]:
-                bid_price_volumes.append(bidding_curve_row[bidding_vol_cols[-1]])
+    spot_price = data['Spot_price'].to_numpy(dtype=np.float64)
+    volume = clear_bidding_curve(spot_price, bid_prices, bid_volumes, producer)
+    volume = np.where(np.isnan(bid_prices).all(axis=-1), np.nan, volume)
+    volume, production = np.broadcast_arrays(volume, production)
+
+    e_plus, e_minus = imbalance_errors(production, volume)
+    cost = imbalance_cost(spot_price,
+                          data['Upregulation_price'].to_numpy(dtype=np.float64),
+                          data['Downregulation_price'].to_numpy(dtype=np.float64),
+                          data['Dominating_direction'].to_numpy(),
+                          e_plus, e_minus, one_price)
+    results = {'Imbalance_cost': cost, 'Profit': spot_price * volume + cost}
+    if optimal:
+        results['Profit_no_error'] = production * spot_price
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results['Optimization_ratio'] = results['Profit'] / results['Profit_no_error']
+        columns = ['Imbalance_cost', 'Profit', 'Profit_no_error', 'Optimization_ratio']
+    else:
+        columns = ['Profit', 'Imbalance_cost']
+
+    valid = (~np.isnan(volume) & ~np.isnan(production)).ravel()
+    result_index = pd.MultiIndex.from_product([names, data.index], names=['Scenario', 'Datetime'])
+    return pd.DataFrame({col_name: results[col_name].ravel()[valid] for col_name in columns},
+                        index=result_index[valid], columns=columns)
+
+
+def backtesting_walk_forward(region,
+                             bidding_curve,
+                             production,
+                             window='30D',
+                             step='1D',
+                             period='MS',
+                             one_price=False,
+                             update=True,
+                             producer=True,
+                             convert_to_utc=False):
+    # Function for reporting the results of a backtest over rolling windows and calendar periods.
+    # Every hour is cleared and settled once, and the aggregates of all the windows are computed from prefix sums,
+    # so the cost grows with the number of hours and not with the number of windows.
+    #
+    # ------ Parameters description ----------
+    # window and step are the length of the rolling windows and the time between their starts (pandas offsets,
+    # e.g. '30D' and '1D'). Only the windows entirely inside the backtested period are returned.
+    # period gives the calendar periods (pandas offset of their starts, e.g. 'MS' for months, 'W-MON' for weeks).
+    # The other parameters have the same meaning as in backtesting_function.
+    #
+    # ------ Output ----------
+    # Two dataframes (rolling windows and calendar periods) indexed by the start of the window, with the end
+    # of the window (excluded) and the sums of Profit, Imbalance_cost, Profit_no_error, E+ and E-,
+    # the Optimization_ratio of the sums and the number of settled Periods (hours, or quarter-hours with a 15-minute
+    # bidding curve).
+    #
+    # ------- Usage example -------------
+    # rolling, monthly = backtesting_walk_forward('SE1', bidding_curve, production, '30D', '1D', 'MS', update=False)
+
+    data = simulate_market(region, bidding_curve, production, one_price, update, producer, convert_to_utc)
+    data['Profit_no_error'] = data['Production'] * data['Spot_price']
+    data = data.sort_index()
+    if data.empty:
+        return window_sums(data, pd.DatetimeIndex([]), pd.DatetimeIndex([])), \
+               window_sums(data, pd.DatetimeIndex([]), pd.DatetimeIndex([]))
+    first_date = data.index[0]
+    # End of the last period settled (e.g. 15 minutes after its start with a 15-minute bidding curve)
+    last_date = data.index[-1] + time_resolution(data.index)
+
+    window = pd.tseries.frequencies.to_offset(window)
+    window_starts = pd.date_range(first_date, last_date - window, freq=step)
+    rolling = window_sums(data, window_starts, window_starts + window)
+
+    period = pd.tseries.frequencies.to_offset(period)
+    period_starts = pd.date_range(period.rollback(first_date.normalize()), last_date, freq=period)
+    period_starts = period_starts[period_starts < last_date]
+    periods = window_sums(data, period_starts, period_starts[1:].append(pd.DatetimeIndex([last_date])))
+    return rolling, periods
+
+
+def window_sums(data, window_starts, window_ends):
+    # Sums of the results over the windows [start, end) from the prefix sums of the results of every period
+    # (nan values are skipped, like with pandas sums)
+    datetimes = data.index.values
+    first_positions = np.searchsorted(datetimes, pd.DatetimeIndex(window_starts).values, side='left')
+    end_positions = np.searchsorted(datetimes, pd.DatetimeIndex(window_ends).values, side='left')
+    result = pd.DataFrame({'Window_end': window_ends}, index=pd.DatetimeIndex(window_starts, name='Datetime'))
+    for col_name in ['Profit', 'Imbalance_cost', 'Profit_no_error', 'E+', 'E-']:
+        prefix_sums = np.concatenate([[0.], np.cumsum(np.nan_to_num(data[col_name].to_numpy(dtype=np.float64)))])
+        result[col_name] = prefix_sums[end_positions] - prefix_sums[first_positions]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['Optimization_ratio'] = result['Profit'] / result['Profit_no_error']
+    result['Periods'] = end_positions - first_positions
+    return result
+
+
+def backtesting_parallel(regions,
+                         bidding_curves,
+                         productions,
+                         one_price=False,
+                         optimal=False,
+                         update=True,
+                         producer=True,
+                         convert_to_utc=False,
+                         chunk_days=90,
+                         workers=None):
+    # Function for simulating the market of several regions and long periods on all the cores.
+    # The work is split by region and by chunks of chunk_days days over a pool of worker processes.
+    # The bidding curves and productions are saved once as arrays in a shared temporary directory (in memory when
+    # /dev/shm exists), and every worker memory-maps the market arrays of its region and dates (see load_market_arrays)
+    # and the rows of its chunk of the curve, instead of receiving pickled dataframes.
+    # The workers write their results in place in shared result arrays.
+    #
+    # ------ Required data structure --------
+    # regions is a region or a list of regions. bidding_curves and productions are either a single bidding curve
+    # and production (see backtesting_function), used for all the regions, or dicts of them keyed by region.
+    #
+    # ------ Parameters description ----------
+    # workers is the number of worker processes (the number of cores by default), with workers=1 the chunks are
+    # run in the current process. The other parameters have the same meaning as in backtesting_function, and the
+    # prices are settled at the time unit of the bidding curves (see load_market_data).
+    #
+    # ------ Output ----------
+    # A single dataframe indexed by (Region, Datetime), with the same columns as backtesting_function.
+    # Hours missing from the bidding curve or the production of a region are not included.
+    #
+    # ------- Usage example -------------
+    # result = backtesting_parallel(['SE1', 'SE2', 'SE3', 'SE4'], bidding_curves, productions, update=False)
+    # result.groupby(level='Region').sum()
+
+    if isinstance(regions, str):
+        regions = [regions]
+    if update:
+        update_prices(stream=True)
+    # Built here if needed, so that the workers do not all build the market arrays at once
+    update_market_arrays()
+    columns = ['Imbalance_cost', 'Profit', 'Profit_no_error', 'Optimization_ratio'] if optimal \
+        else ['Profit', 'Imbalance_cost']
+
+    directory = shared_directory()
+    try:
+        tasks = []
+        region_curves = []
+        # Inputs already shared, by identity of the bidding curve and the production (e.g. the same for all the regions)
+        shared_inputs = {}
+        for region in regions:
+            bidding_curve = bidding_curves[region] if isinstance(bidding_curves, dict) else bidding_curves
+            production = productions[region] if isinstance(productions, dict) else productions
+            key = (id(bidding_curve), id(production))
+            if isinstance(production, pd.DataFrame):
+                production = production['Production']
+            if not bidding_curve.index.is_monotonic_increasing:
+                bidding_curve = bidding_curve.sort_index(kind='mergesort')
+            datetimes = pd.DatetimeIndex(bidding_curve.index).values.astype('datetime64[ns]')
+            if key not in shared_inputs:
+                if not production.index.equals(bidding_curve.index):
+                    production = production.reindex(bidding_curve.index)
+                shared_inputs[key] = {'Datetime': share_array(directory, region + '_Datetime', datetimes),
+                                      'bidding_curve': share_array(directory, region + '_bidding_curve',
+                                                                   bidding_curve.to_numpy(dtype=np.float64)),
+                                      'Production': share_array(directory, region + '_Production',
+                                                                production.to_numpy(dtype=np.float64))}
+            shared_paths = dict(shared_inputs[key])
+            shared_paths.update({col_name: shared_result(directory, region + '_' + col_name, len(datetimes))
+                                 for col_name in RESULT_COLUMNS + [SETTLED_COLUMN]})
+            region_curves.append((region, datetimes, bidding_curve.index.tz, shared_paths))
+            if len(datetimes) == 0:
                 continue
-            bid_price_idx = next(bidding_price_cols.index(col_name) for col_name in bidding_price_cols if row['Spot_price'] < bidding_curve_row[col_name])
-            # If spot price is below smallest bidding price, assign 0 volume
-            if bid_price_idx == 0:
-                bid_price_volumes.append(0)
-            else:
-                bid_price_volumes.append(bidding_curve_row[bidding_vol_cols[bid_price_idx]] -
-                                     ((bidding_curve_row[bidding_price_cols[bid_price_idx]] - row['Spot_price'])/
-                                    (bidding_curve_row[bidding_price_cols[bid_price_idx]] - bidding_curve_row[bidding_price_cols[bid_price_idx - 1]]))*
-                              (bidding_curve_row[bidding_vol_cols[bid_price_idx]] - bidding_curve_row[bidding_vol_cols[bid_price_idx - 1]]))
+
+            # Split the rows of the region (sorted by datetime) in chunks of chunk_days days
+            price_cols = [i for i, col_name in enumerate(bidding_curve.columns) if 'price' in col_name]
+            volume_cols = [i for i, col_name in enumerate(bidding_curve.columns) if 'volume' in col_name]
+            chunk_starts = pd.date_range(datetimes[0], datetimes[-1], freq=timedelta(days=chunk_days)).values
+            bounds = list(np.searchsorted(datetimes, chunk_starts)) + [len(datetimes)]
+            tasks += [(region, shared_paths, first, last, price_cols, volume_cols, bidding_curve.index.tz,
+                       time_resolution(bidding_curve.index), one_price, producer, optimal, convert_to_utc)
+                      for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+
+        if workers == 1:
+            for task in tasks:
+                backtest_chunk(*task)
         else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(backtest_chunk, *task) for task in tasks]
+                for future in futures:
+                    future.result()
 
-            # If x is the volume we are trying to determine, x1 the bid volume directly smaller, x2 directly larger,
-            # y being the spot price, y1 the bid price directly smaller and y2 directly larger,
-            # then x = x2 - (y1 - y)/(y1-y2)*(x2-x1) (NB: different than producer due to the trend of the curve)
-            # Here, we are trying to find the column containing y2, and then finding all the other values from their relative
-            # position to y2 in the dataframe.
-            # The prices/volumes are supposed to be sorted in the increasing order,
-            # the bid price/volume columns supposed to be directly next one to another for a specific one,
-            # and the first column is supposed to be the first bid price (followed by the first bid volume etc).
-            #
-
-            bidding_curve_row = bidding_curve.loc[idx]
-            # If spot price is under smallest bidding price, assign biggest bidding volume
-            if row['Spot_price'] < bidding_curve_row[bidding_price_cols[0]]:
-                bid_price_volumes.append(bidding_curve_row[bidding_vol_cols[0]])
-                continue
-            bid_price_idx = next((bidding_price_cols.index(col_name) for col_name in bidding_price_cols if
-                                 row['Spot_price'] < bidding_curve_row[col_name]), -1)
-            # If spot price is above biggest bidding price, assign 0 volume
-            if bid_price_idx == -1:
-                bid_price_volumes.append(0)
-            else:
-                bid_price_volumes.append(bidding_curve_row[bidding_vol_cols[bid_price_idx]] -
-                                         ((bidding_curve_row[bidding_price_cols[bid_price_idx - 1]] - row['Spot_price']) /
-                                          (bidding_curve_row[bidding_price_cols[bid_price_idx - 1]] - bidding_curve_row[bidding_price_cols[bid_price_idx]])) *
-                                         (bidding_curve_row[bidding_vol_cols[bid_price_idx]] - bidding_curve_row[bidding_vol_cols[bid_price_idx - 1]]))
-
-    data['Volume'] = bid_price_volumes
-    if verbose:
-        print(production.head())
+        results = []
+        for region, datetimes, tz, shared_paths in region_curves:
+            settled = np.load(shared_paths[SETTLED_COLUMN]) == 1
+            values = {col_name: np.load(shared_paths[col_name])[settled] for col_name in columns}
+            index = pd.DatetimeIndex(datetimes[settled])
+            if tz is not None:
+                index = index.tz_localize('UTC').tz_convert(tz)
+            result_index = pd.MultiIndex.from_arrays([np.full(settled.sum(), region, dtype=object), index],
+                                                     names=['Region', 'Datetime'])
+            results.append(pd.DataFrame(values, index=result_index, columns=columns))
+    finally:
+        remove_shared_directory(directory)
+    return pd.concat(results)
+
+
+def backtest_chunk(region, shared_paths, first, last, price_cols, volume_cols, tz=None, resolution='1h',
+                   one_price=False, producer=True, optimal=False, convert_to_utc=False):
+    # Clear and settle the rows [first, last) of the bidding curve of a region shared by backtesting_parallel,
+    # and write their results in the shared result arrays. Runs in the worker processes.
+    # The market data of the dates of the chunk is read from the memory-mapped market arrays (without the market data
+    # cache), and only the rows of the chunk with market data are read from the shared curve and production.
+    index = pd.DatetimeIndex(np.array(np.load(shared_paths['Datetime'], mmap_mode='r')[first:last]), name='Datetime')
+    if tz is not None:
+        index = index.tz_localize('UTC').tz_convert(tz)
+    market = market_data_range(region, index[0], index[-1], convert_to_utc, cache=False)
+    data = select_datetimes(market_data_at_resolution(region, market, resolution), index)
+    positions = first + index.get_indexer(data.index)
+
+    curve = np.load(shared_paths['bidding_curve'], mmap_mode='r')[positions]
+    bid_prices = curve[:, price_cols]
+    bid_volumes = curve[:, volume_cols]
+    production = np.load(shared_paths['Production'], mmap_mode='r')[positions]
+    # Hours missing from the bidding curve or the production are not settled
+    valid = ~np.isnan(bid_prices).all(axis=-1) & ~np.isnan(production)
+    results = settle_arrays(data['Spot_price'].to_numpy(dtype=np.float64)[valid],
+                            data['Upregulation_price'].to_numpy(dtype=np.float64)[valid],
+                            data['Downregulation_price'].to_numpy(dtype=np.float64)[valid],
+                            data['Dominating_direction'].to_numpy()[valid],
+                            production[valid], bid_prices[valid], bid_volumes[valid], one_price, producer, optimal)
+    write_results(shared_paths, positions[valid], results)
+    return len(positions)
+
+
+def backtesting_settlements(region,
+                            bidding_curve,
+                            production,
+                            systems=('one_price', 'two_prices'),
+                            sides=('producer', 'retailer'),
+                            optimal=True,
+                            update=True,
+                            convert_to_utc=False):
+    # Function for comparing the settlement systems and sides on the same inputs.
+    # The market data is loaded and merged once, the bidding curve is cleared once per side,
+    # and the imbalance costs of all the systems are computed for all the sides in one vectorized pass.
+    #
+    # ------ Parameters description ----------
+    # systems is a list of settlement systems among 'one_price' and 'two_prices',
+    # and sides a list of sides among 'producer' and 'retailer'.
+    # The other parameters have the same meaning as in backtesting_function (settled at the time unit of the curve).
+    #
+    # ------ Output ----------
+    # A single dataframe with one block of columns per (side, system), each block having the same columns as
+    # the output of backtesting_function with the corresponding one_price, producer and optimal parameters.
+    #
+    # ------- Usage example -------------
+    # result = backtesting_settlements('SE1', bidding_curve, production, update=False)
+    # result['producer', 'one_price'].sum()
+    # result.xs('Profit', axis=1, level=2).sum()
+
+    for system in systems:
+        if system not in ('one_price', 'two_prices'):
+            raise ValueError('Unknown settlement system: {0}'.format(system))
+    for side in sides:
+        if side not in ('producer', 'retailer'):
+            raise ValueError('Unknown side: {0}'.format(side))
+
+    data = load_market_data(region, bidding_curve.index, update, convert_to_utc)
+    volumes = pd.DataFrame({side: cleared_volumes(data, bidding_curve, side == 'producer') for side in sides},
+                           index=data.index, columns=list(sides))
+    data = data[['Spot_price', 'Upregulation_price', 'Downregulation_price', 'Dominating_direction']].join(volumes)
     data = data.merge(production, left_index=True, right_index=True)
-    if verbose:
-        print(data.head())
 
-    # Calculate positive and negative errors
-    data['E+'] = np.maximum(data['Production'] - data['Volume'], 0)
-    data['E-'] = np.minimum(data['Production'] - data['Volume'], 0)
-    if one_price:
-        # If one price system
-
-        # If upregulation as dominating direction
-        data.loc[data['Dominating_direction'] == 1,'Imbalance_cost'] = data['Upregulation_price'] * data['E+'] \
-                                                                         + data['Upregulation_price'] * data['E-']
-        # If downregulation as dominating direction
-        data.loc[data['Dominating_direction'] == -1,'Imbalance_cost'] = data['Downregulation_price'] * data['E+'] \
-                                                                        + data['Downregulation_price'] * data['E-']
-        # If unregulation
-        data.loc[data['Dominating_direction'] == 0, 'Imbalance_cost'] = data['Spot_price'] * data['E+'] \
-                                                                        + data['Spot_price'] * data['E-']
-    else:
-        # If two prices system
-
-        # If upregulation as dominating direction
-        data.loc[data['Dominating_direction'] == 1, 'Imbalance_cost'] = data['Downregulation_price'] * data['E+'] \
-                                                                         + data['Upregulation_price'] * data['E-']
-        # If downregulation as dominating direction
-        data.loc[data['Dominating_direction'] == -1, 'Imbalance_cost'] = data['Downregulation_price'] * data['E+'] \
-                                                                        + data['Upregulation_price'] * data['E-']
-        # If unregulation
-        data.loc[data['Dominating_direction'] == 0, 'Imbalance_cost'] = data['Spot_price'] * data['E+'] \
-                                                                        + data['Spot_price'] * data['E-']
+    spot_price = data['Spot_price'].to_numpy(dtype=np.float64)
+    # One row per side
+    volume = data[list(sides)].to_numpy(dtype=np.float64).T
+    e_plus, e_minus = imbalance_errors(data['Production'].to_numpy(dtype=np.float64), volume)
+    profit_no_error = data['Production'].to_numpy(dtype=np.float64) * spot_price
 
-    data['Profit'] = data['Spot_price'] * data['Volume'] + data['Imbalance_cost']
-    if verbose:
-        print(data[['Spot_price','Downregulation_price','Upregulation_price','Dominating_direction','Production','E+','E-','Imbalance_cost']])
-    if optimal:
-        data['Profit_no_error'] = data['Production'] * data['Spot_price']
-        data['Optimization_ratio'] = data['Profit']/data['Profit_no_error']
-        return data[['Imbalance_cost','Profit','Profit_no_error','Optimization_ratio']]
-    else:
-        return data[['Profit','Imbalance_cost']]
+    results = OrderedDict()
+    for system in systems:
+        cost = imbalance_cost(spot_price,
+                              data['Upregulation_price'].to_numpy(dtype=np.float64),
+                              data['Downregulation_price'].to_numpy(dtype=np.float64),
+                              data['Dominating_direction'].to_numpy(),
+                              e_plus, e_minus, system == 'one_price')
+        profit = spot_price * volume + cost
+        for i, side in enumerate(sides):
+            results[side, system, 'Imbalance_cost'] = cost[i]
+            results[side, system, 'Profit'] = profit[i]
+            if optimal:
+                results[side, system, 'Profit_no_error'] = profit_no_error
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    results[side, system, 'Optimization_ratio'] = profit[i] / profit_no_error
+    columns = pd.MultiIndex.from_tuples([(side, system, col_name) for side in sides for system in systems
+                                         for col_name in (['Imbalance_cost', 'Profit', 'Profit_no_error',
+                                                           'Optimization_ratio'] if optimal
+                                                          else ['Profit', 'Imbalance_cost'])])
+    return pd.DataFrame({column: results[column] for column in columns}, index=data.index, columns=columns)
+
+
+def backtesting_stream(region,
+                       bidding_curve,
+                       production,
+                       one_price=False,
+                       optimal=False,
+                       update=True,
+                       producer=True,
+                       convert_to_utc=False,
+                       chunk='MS',
+                       first_date=None,
+                       last_date=None,
+                       resolution=None):
+    # Generator simulating the market one chunk of time at a time (e.g. one month), so that the memory used
+    # is bounded by the size of a chunk and not by the length of the backtested period.
+    # Only the prices of the chunk are read from the price store (and they are not kept in the market data cache).
+    #
+    # ------ Required data structure --------
+    # bidding_curve and production can be given as in backtesting_function, or as functions called with the first
+    # and the last datetimes of every chunk (both included) and returning the bidding curve or the production of
+    # these datetimes, so that they never have to be loaded entirely. first_date and last_date are then required.
+    #
+    # ------ Parameters description ----------
+    # chunk gives the starts of the chunks (pandas offset, e.g. 'MS' for months, 'W-MON' for weeks, '7D').
+    # first_date and last_date limit the backtested period (the whole bidding curve by default).
+    # The other parameters have the same meaning as in backtesting_function.
+    #
+    # ------ Output ----------
+    # Yields (chunk start, result) pairs, result being the output of backtesting_function for the hours of the chunk.
+    #
+    # ------- Usage example -------------
+    # for month, result in backtesting_stream('SE1', bidding_curve, production, update=False):
+    #     print(month, result['Profit'].sum())
+
+    if update:
+        update_prices(stream=True)
+    if callable(bidding_curve) and (first_date is None or last_date is None):
+        raise ValueError('first_date and last_date are required when the bidding curve is a function')
+    if first_date is None:
+        first_date = bidding_curve.index.min()
+    if last_date is None:
+        last_date = bidding_curve.index.max()
+    first_date = pd.Timestamp(first_date)
+    last_date = pd.Timestamp(last_date)
+    if pd.isna(first_date) or pd.isna(last_date):
+        return
+
+    chunk = pd.tseries.frequencies.to_offset(chunk)
+    chunk_starts = pd.date_range(chunk.rollback(first_date.normalize()), last_date, freq=chunk)
+    chunk_starts = chunk_starts[chunk_starts <= last_date]
+    chunk_ends = list(chunk_starts[1:] - pd.Timedelta(1, unit='ns')) + [last_date]
+    for chunk_start, chunk_end in zip(chunk_starts, chunk_ends):
+        chunk_start = max(chunk_start, first_date)
+        if callable(bidding_curve):
+            chunk_curve = bidding_curve(chunk_start, chunk_end)
+        else:
+            chunk_curve = chunk_rows(bidding_curve, chunk_start, chunk_end)
+        if callable(production):
+            chunk_production = production(chunk_start, chunk_end)
+        else:
+            chunk_production = production[(production.index >= chunk_start) & (production.index <= chunk_end)]
+        if len(chunk_curve.index) == 0:
+            continue
+        data = simulate_market(region, chunk_curve, chunk_production, one_price, False, producer, convert_to_utc,
+                               resolution=resolution, cache=False)
+        if optimal:
+            data['Profit_no_error'] = data['Production'] * data['Spot_price']
+            data['Optimization_ratio'] = data['Profit']/data['Profit_no_error']
+            yield chunk_start, data[['Imbalance_cost','Profit','Profit_no_error','Optimization_ratio']]
+        else:
+            yield chunk_start, data[['Profit','Imbalance_cost']]
+        del data
+
+
+def chunk_rows(bidding_curve, first_date, last_date):
+    # Rows of a bidding curve (dataframe or RaggedCurve) between two datetimes, both included
+    in_chunk = (bidding_curve.index >= first_date) & (bidding_curve.index <= last_date)
+    if isinstance(bidding_curve, RaggedCurve):
+        return select_ragged(bidding_curve, bidding_curve.index[in_chunk])
+    return bidding_curve[in_chunk]
+
+
+def backtesting_stream_totals(region,
+                              bidding_curve,
+                              production,
+                              one_price=False,
+                              update=True,
+                              producer=True,
+                              convert_to_utc=False,
+                              chunk='MS',
+                              first_date=None,
+                              last_date=None,
+                              resolution=None):
+    # Run backtesting_stream and fold the hourly results into running sums, keeping only one row per chunk.
+    # The parameters are the ones of backtesting_stream.
+    #
+    # ------ Output ----------
+    # A dataframe indexed by the chunk starts with the sums of Profit, Imbalance_cost and Profit_no_error,
+    # the Optimization_ratio of the sums and the number of settled Periods (hours, or e.g. quarter-hours with
+    # resolution='15min'), and a series with the totals of the whole period.
+    #
+    # ------- Usage example -------------
+    # monthly, total = backtesting_stream_totals('SE1', bidding_curve, production, update=False)
+
+    columns = ['Profit', 'Imbalance_cost', 'Profit_no_error']
+    rows = []
+    for chunk_start, result in backtesting_stream(region, bidding_curve, production, one_price, True, update, producer,
+                                                  convert_to_utc, chunk, first_date, last_date, resolution):
+        rows.append([chunk_start] + [result[col_name].sum() for col_name in columns] + [len(result)])
+    sums = pd.DataFrame([row[1:] for row in rows], columns=columns + ['Periods'],
+                        index=pd.DatetimeIndex([row[0] for row in rows], name='Datetime'))
+    totals = sums.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sums.insert(3, 'Optimization_ratio', sums['Profit'] / sums['Profit_no_error'])
+        totals['Optimization_ratio'] = totals['Profit'] / totals['Profit_no_error']
+    return sums, totals
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import get_data
+import backtesting
+import utils
+from price_store import write_prices
+from wrapper_Ilias import wrapper_bidding_curve_Ilias, wrapper_production_Ilias
+
+# Benchmark of the main code paths on synthetic data of configurable size
+# Example call: python benchmark.py --hours 8760 --regions 4 --points 64 --scenarios 16 --save baseline.json
+# and after an upgrade: python benchmark.py --hours 8760 --regions 4 --points 64 --scenarios 16 --compare baseline.json
+#
+# The timings are the best of --repeat runs, the peak memory is measured with tracemalloc on a separate run.
+# With --compare, the command fails if a benchmark is slower (or uses more memory) than the baseline
+# by more than the --tolerance factor.
+
+default_start = '2017-01-01'
+
+
+def synthetic_regions(n_regions):
+    return ['SE' + str(i + 1) for i in range(n_regions)]
+
+
+def synthetic_price_rows(days, regions, start=default_start, seed=0):
+    # Rows of the regional_elspot and regional_regulating tables (see spot_price_parse_results and
+    # reg_price_parse_results), with 23 and 25 hours on the days of the daylight saving time changes
+    rng = np.random.RandomState(seed)
+    first_day = pd.Timestamp(start).date()
+    spot_rows = []
+    reg_rows = []
+    for d in range(days):
+        day = first_day + timedelta(days=d)
+        hours = len(pd.date_range(pd.Timestamp(day).tz_localize('CET'),
+                                  pd.Timestamp(day + timedelta(days=1)).tz_localize('CET'), freq='h')) - 1
+        for region in regions:
+            spot = np.round(rng.uniform(10, 60, hours), 2)
+            spot_rows.append((region, 'EUR', day, day, spot.sum(), list(spot)))
+            spot_rows.append((region, 'SEK', day, day, 10 * spot.sum(), list(10 * spot)))
+            upregulation = spot + np.round(rng.uniform(0, 10, hours), 2)
+            downregulation = spot - np.round(rng.uniform(0, 10, hours), 2)
+            directions = rng.randint(-1, 2, hours).astype(np.float64)
+            reg_rows.append((region, day, day, upregulation.sum(), list(upregulation), 'price', 'RO'))
+            reg_rows.append((region, day, day, downregulation.sum(), list(downregulation), 'price', 'RN'))
+            reg_rows.append((region, day, day, directions.sum(), list(directions), 'direction', 'DD'))
+    return spot_rows, reg_rows
+
+
+def synthetic_bidding_curve(hours, points, start=default_start, seed=0):
+    # Bidding curve dataframe (see backtesting_function) with increasing prices and volumes
+    rng = np.random.RandomState(seed)
+    prices = np.cumsum(rng.uniform(0.5, 80. / points, (hours, points)), axis=1)
+    volumes = np.cumsum(rng.uniform(0, 1000. / points, (hours, points)), axis=1)
+    columns = [col_name for i in range(points) for col_name in ('bid_price_' + str(i + 1), 'bid_volume_' + str(i + 1))]
+    return pd.DataFrame(np.stack([prices, volumes], axis=2).reshape(hours, 2 * points), columns=columns,
+                        index=pd.DatetimeIndex(pd.date_range(start, periods=hours, freq='h'), name='Datetime'))
+
+
+def synthetic_production(hours, start=default_start, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({'Production': rng.uniform(0, 1000, hours)},
+                        index=pd.DatetimeIndex(pd.date_range(start, periods=hours, freq='h'), name='Datetime'))
+
+
+def synthetic_npz(file_name, hours, points, seed=0):
+    # Forecast archive in the format read by the wrapper_Ilias loaders, saved without compression
+    curve = synthetic_bidding_curve(hours, points, seed=seed).values.reshape(hours, points, 2)
+    arrays = {'bidcurves' + str(i + 1): curve[i] for i in range(hours)}
+    arrays['actualgen'] = synthetic_production(hours, seed=seed)['Production'].values.reshape(-1, 24)
+    np.savez(file_name, **arrays)
+
+
+class FakeCursor:
+    # Cursor returning the given rows, to benchmark the parsing of the query results without a database
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += size
+        return rows
+
+
+def use_data_directory(directory):
+    # Point get_data to the stores of another data directory
+    get_data.spot_prices_data_path = os.path.join(directory, 'spot_prices.csv')
+    get_data.regulation_prices_data_path = os.path.join(directory, 'regulation_prices.csv')
+    get_data.spot_prices_store_path = os.path.join(directory, 'spot_prices')
+    get_data.regulation_prices_store_path = os.path.join(directory, 'regulation_prices')
+    get_data.market_store_path = os.path.join(directory, 'market')
+
+
+def clear_backtesting_caches():
+    # Empty the market data and cleared volumes caches, so that every run loads, clears and settles again
+    backtesting.clear_market_data_cache()
+    backtesting.clear_cleared_volumes_cache()
+
+
+def measure(function, repeat=3, setup=None):
+    # Best time of repeat runs and peak memory (tracemalloc) of one more run, setup being called before each run
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_memory_mb': peak / 2 ** 20}
+
+
+def run_benchmarks(hours=24 * 365, n_regions=4, points=64, scenarios=16, repeat=3, batch_size=10000):
+    # Run all the benchmarks on synthetic data of the given size and return their results by name
+    regions = synthetic_regions(n_regions)
+    days = -(-hours // 24)
+    spot_rows, reg_rows = synthetic_price_rows(days + 2, regions)
+    bidding_curve = synthetic_bidding_curve(hours, points)
+    production = synthetic_production(hours)
+    results = {}
+
+    # Parsing of the query results
+    results['get_data.spot_price_batches'] = measure(
+        lambda: pd.concat(list(get_data.spot_price_batches(FakeCursor(spot_rows), batch_size))), repeat)
+    results['get_data.reg_price_batches'] = measure(
+        lambda: pd.concat(list(get_data.reg_price_batches(FakeCursor(reg_rows), batch_size))), repeat)
+
+    directory = tempfile.mkdtemp(prefix='backtesting_benchmark_')
+    try:
+        use_data_directory(directory)
+        write_prices(pd.concat(list(get_data.spot_price_batches(FakeCursor(spot_rows), batch_size))),
+                     get_data.spot_prices_store_path)
+        write_prices(pd.concat(list(get_data.reg_price_batches(FakeCursor(reg_rows), batch_size))),
+                     get_data.regulation_prices_store_path)
+        get_data.build_market_arrays()
+
+        # Whole backtests, from the price store (the market data cache is cleared before each run)
+        for producer in (True, False):
+            for one_price in (False, True):
+                name = 'backtesting_function[{0},{1}]'.format('producer' if producer else 'retailer',
+                                                              'one_price' if one_price else 'two_prices')
+                results[name] = measure(
+                    lambda: [backtesting.backtesting_function(region, bidding_curve, production, one_price,
+                                                              True, False, producer) for region in regions],
+                    repeat, clear_backtesting_caches)
+        # Clearing of one region, without the memo, on a miss (hash of the whole curve and clearing) and on a hit
+        data = backtesting.load_market_data(regions[0], bidding_curve.index, False)
+        results['cleared_volumes'] = measure(lambda: backtesting.cleared_volumes(data, bidding_curve), repeat)
+        results['cleared_volumes[memo miss]'] = measure(
+            lambda: backtesting.cleared_volumes(data, bidding_curve, memoize=True), repeat,
+            backtesting.clear_cleared_volumes_cache)
+        results['cleared_volumes[memo hit]'] = measure(
+            lambda: backtesting.cleared_volumes(data, bidding_curve, memoize=True), repeat)
+        curves = {i: synthetic_bidding_curve(hours, points, seed=i) for i in range(scenarios)}
+        results['backtesting_batch'] = measure(
+            lambda: backtesting.backtesting_batch(regions[0], curves, production, update=False),
+            repeat, clear_backtesting_caches)
+
+        # Conversion to UTC (the conversion cache is cleared before each run)
+        cet_prices = get_data.load_spot_prices(regions)
+        results['utils.cet_to_utc'] = measure(lambda: utils.cet_to_utc(cet_prices, 'Datetime'),
+                                              repeat, utils.cet_to_utc_cache.clear)
+
+        # Forecast archive loaders
+        file_name = os.path.join(directory, 'forecasts.npz')
+        synthetic_npz(file_name, 24 * days, points)
+        for mmap in (False, True):
+            suffix = '[mmap]' if mmap else ''
+            results['wrapper_bidding_curve_Ilias' + suffix] = measure(
+                lambda: wrapper_bidding_curve_Ilias(file_name, mmap=mmap), repeat)
+            results['wrapper_production_Ilias' + suffix] = measure(
+                lambda: wrapper_production_Ilias(file_name, mmap=mmap), repeat)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare_results(results, baseline, tolerance=1.25):
+    # Print the ratios of the results to the baseline, and return the names of the regressions
+    regressions = []
+    print('{0:<50} {1:>10} {2:>10} {3:>12} {4:>12}'.format('benchmark', 'seconds', 'ratio', 'peak (MB)', 'ratio'))
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print('{0:<50} {1:>10.4f} {2:>10} {3:>12.1f} {4:>12}'.format(name, result['seconds'], '-',
+                                                                        result['peak_memory_mb'], '-'))
+            continue
+        time_ratio = result['seconds'] / max(reference['seconds'], 1e-9)
+        memory_ratio = result['peak_memory_mb'] / max(reference['peak_memory_mb'], 1e-9)
+        print('{0:<50} {1:>10.4f} {2:>10.2f} {3:>12.1f} {4:>12.2f}'.format(name, result['seconds'], time_ratio,
+                                                                          result['peak_memory_mb'], memory_ratio))
+        if time_ratio > tolerance or memory_ratio > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the backtesting code on synthetic data.')
+    parser.add_argument('--hours', type=int, default=24 * 365, help='number of hours of the backtests')
+    parser.add_argument('--regions', type=int, default=4, help='number of regions of the price store')
+    parser.add_argument('--points', type=int, default=64, help='number of points of the bidding curves')
+    parser.add_argument('--scenarios', type=int, default=16, help='number of scenarios of the batch backtest')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark')
+    parser.add_argument('--save', help='save the results as a baseline to this JSON file')
+    parser.add_argument('--compare', help='compare the results to the baseline saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='maximum ratio to the baseline before a benchmark is reported as a regression')
+    args = parser.parse_args(args)
+
+    sizes = {'hours': args.hours, 'regions': args.regions, 'points': args.points, 'scenarios': args.scenarios}
+    results = run_benchmarks(args.hours, args.regions, args.points, args.scenarios, args.repeat)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved['sizes'] != sizes:
+            print('Warning: the baseline was measured with other sizes: {0}'.format(saved['sizes']))
+        baseline = saved['results']
+    regressions = compare_results(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'sizes': sizes, 'date': date.today().isoformat(), 'versions': {
+                'python': sys.version.split()[0], 'numpy': np.__version__, 'pandas': pd.__version__},
+                'results': results}, f, indent=2)
+    if regressions:
+        print('Regressions: {0}'.format(', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
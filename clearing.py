@@ -0,0 +1,175 @@
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# Bidding curves with a variable number of points per hour, stored like a CSR sparse matrix:
+# the points of the hour i are prices[offsets[i]:offsets[i+1]] and volumes[offsets[i]:offsets[i+1]],
+# index gives the datetimes of the hours and offsets has one more element than index.
+RaggedCurve = namedtuple('RaggedCurve', ['index', 'offsets', 'prices', 'volumes'])
+
+
+def bidding_curve_arrays(bidding_curve, index=None):
+    # Convert a wide bidding curve dataframe to two 2-D arrays (one row per hour, one column per curve point)
+    # Example call: bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve, data.index)
+    #
+    # --- Arguments description --
+    # The bidding curve should follow the structure described in backtesting_function, the price columns
+    # being the ones containing 'price' and the volume columns the ones containing 'volume', in column order.
+    # If index is provided, the rows of the bidding curve are looked up for these datetimes (like bidding_curve.loc[index]).
+    bidding_price_cols = [col_name for col_name in bidding_curve.columns if 'price' in col_name]
+    bidding_vol_cols = [col_name for col_name in bidding_curve.columns if 'volume' in col_name]
+    if index is not None:
+        bidding_curve = bidding_curve.loc[index]
+    bid_prices = bidding_curve[bidding_price_cols].to_numpy(dtype=np.float64)
+    bid_volumes = bidding_curve[bidding_vol_cols].to_numpy(dtype=np.float64)
+    return bid_prices, bid_volumes
+
+
+def clear_bidding_curve(spot_prices, bid_prices, bid_volumes, producer=True):
+    # Compute the cleared volume of every hour in one batched pass
+    # Example call: volumes = clear_bidding_curve(data['Spot_price'].values, bid_prices, bid_volumes)
+    #
+    # --- Arguments description --
+    # spot_prices is a 1-D array with one spot price per hour.
+    # bid_prices and bid_volumes are 2-D arrays with one row per hour and one column per curve point,
+    # as returned by bidding_curve_arrays. Leading dimensions are broadcast, so a stack of curves with shape
+    # (scenarios, hours, points) can be cleared against the same spot prices at once.
+    # Set producer to False to clear the curve on the retailer side.
+    #
+    # For every hour, the point y2 is the first bid price strictly above the spot price y (same rule as the
+    # original row by row scan), y1 and x1 are the price and volume of the previous point and x2 the volume of y2.
+    # Producer: x = x2 - (y2 - y)/(y2-y1)*(x2-x1), 0 below the first bid price, last volume from the last bid price.
+    # Retailer: x = x2 - (y1 - y)/(y1-y2)*(x2-x1), first volume below the first bid price, 0 above the last bid price.
+    # Curves shorter than the others can be padded with nan at the end (see from_ragged), the last point of an hour
+    # being its last point with a price.
+    spot_prices = np.asarray(spot_prices, dtype=np.float64)
+    bid_prices = np.asarray(bid_prices, dtype=np.float64)
+    bid_volumes = np.asarray(bid_volumes, dtype=np.float64)
+    n_points = bid_prices.shape[-1]
+    spot = np.broadcast_to(spot_prices, bid_prices.shape[:-1])[..., np.newaxis]
+    n_valid = (~np.isnan(bid_prices)).sum(axis=-1)[..., np.newaxis]
+    # Hours without any point keep the last column, like before
+    last = np.where(n_valid > 0, n_valid - 1, n_points - 1)
+
+    above_spot = spot < bid_prices
+    found = above_spot.any(axis=-1)
+    # First point strictly above the spot price, and the previous one (wrapping around to the last point like a
+    # python list index)
+    idx_2 = above_spot.argmax(axis=-1)[..., np.newaxis]
+    idx_1 = np.where(idx_2 > 0, idx_2 - 1, last)
+    y2 = np.take_along_axis(bid_prices, idx_2, axis=-1)[..., 0]
+    y1 = np.take_along_axis(bid_prices, idx_1, axis=-1)[..., 0]
+    x2 = np.take_along_axis(bid_volumes, idx_2, axis=-1)[..., 0]
+    x1 = np.take_along_axis(bid_volumes, idx_1, axis=-1)[..., 0]
+    last_price = np.take_along_axis(bid_prices, last, axis=-1)[..., 0]
+    last_volume = np.take_along_axis(bid_volumes, last, axis=-1)[..., 0]
+    idx_2 = idx_2[..., 0]
+    spot = spot[..., 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if producer:
+            volumes = x2 - ((y2 - spot) / (y2 - y1)) * (x2 - x1)
+            # If spot price is below smallest bidding price, assign 0 volume
+            volumes = np.where(idx_2 == 0, 0., volumes)
+            # If spot price is above (or equal to) biggest bidding price, assign biggest bidding volume
+            volumes = np.where(found & ~(spot > last_price), volumes, last_volume)
+        else:
+            volumes = x2 - ((y1 - spot) / (y1 - y2)) * (x2 - x1)
+            # If spot price is above biggest bidding price, assign 0 volume
+            volumes = np.where(found, volumes, 0.)
+            # If spot price is under smallest bidding price, assign biggest bidding volume
+            volumes = np.where(spot < bid_prices[..., 0], bid_volumes[..., 0], volumes)
+    # Missing spot prices cannot be cleared
+    return np.where(np.isnan(spot), np.nan, volumes)
+
+
+def to_ragged(bidding_curve):
+    # Convert a wide bidding curve dataframe (see backtesting_function) to a RaggedCurve, without its nan points
+    # Example call: ragged_curve = to_ragged(wrapper_bidding_curve_Ilias('day_1_2017.npz'))
+    bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve)
+    points = ~np.isnan(bid_prices)
+    offsets = np.concatenate([[0], np.cumsum(points.sum(axis=1))]).astype(np.int64)
+    return RaggedCurve(bidding_curve.index, offsets, bid_prices[points], bid_volumes[points])
+
+
+def from_ragged(ragged_curve):
+    # Convert a RaggedCurve to a wide bidding curve dataframe, the shorter curves being padded with nan
+    # Example call: bidding_curve = from_ragged(ragged_curve)
+    lengths = np.diff(ragged_curve.offsets)
+    n_points = int(lengths.max()) if len(lengths) else 0
+    rows, positions = ragged_positions(ragged_curve.offsets)
+    curves = np.full((len(lengths), n_points, 2), np.nan)
+    curves[rows, positions, 0] = ragged_curve.prices
+    curves[rows, positions, 1] = ragged_curve.volumes
+    columns = [col_name for i in range(n_points) for col_name in ('bid_price_' + str(i + 1), 'bid_volume_' + str(i + 1))]
+    return pd.DataFrame(curves.reshape(len(lengths), 2 * n_points), columns=columns, index=ragged_curve.index)
+
+
+def ragged_positions(offsets):
+    # Hour and position in the curve of every point of a RaggedCurve
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    return rows, np.arange(len(rows)) - np.repeat(offsets[:-1], lengths)
+
+
+def select_ragged(ragged_curve, index):
+    # Select the hours of a RaggedCurve for the given datetimes (like bidding_curve.loc[index])
+    hours = pd.DatetimeIndex(ragged_curve.index).get_indexer(index)
+    if (hours < 0).any():
+        raise KeyError('Some datetimes are not in the bidding curve')
+    offsets = np.asarray(ragged_curve.offsets)
+    lengths = offsets[hours + 1] - offsets[hours]
+    new_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    points = np.repeat(offsets[hours] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return RaggedCurve(index, new_offsets, np.asarray(ragged_curve.prices)[points],
+                       np.asarray(ragged_curve.volumes)[points])
+
+
+def clear_ragged_curve(spot_prices, ragged_curve, producer=True):
+    # Compute the cleared volume of every hour of a RaggedCurve in one batched pass,
+    # with the same rules as clear_bidding_curve applied to the points of each hour
+    # Example call: volumes = clear_ragged_curve(data['Spot_price'].values, select_ragged(ragged_curve, data.index))
+    #
+    # spot_prices has one spot price per hour of the curve. Hours without any point get a nan volume.
+    spot = np.asarray(spot_prices, dtype=np.float64)
+    offsets = np.asarray(ragged_curve.offsets, dtype=np.int64)
+    prices = np.asarray(ragged_curve.prices, dtype=np.float64)
+    volumes = np.asarray(ragged_curve.volumes, dtype=np.float64)
+    if len(prices) == 0:
+        return np.full(len(spot), np.nan)
+    starts = offsets[:-1]
+    ends = offsets[1:]
+    not_empty = ends > starts
+    rows, _ = ragged_positions(offsets)
+
+    # First point strictly above the spot price in each hour (ends when there is none)
+    points = np.arange(len(prices))
+    above_spot = np.where(spot[rows] < prices, points, len(prices))
+    first_above = ends.copy()
+    if not_empty.any():
+        first_above[not_empty] = np.minimum(np.minimum.reduceat(above_spot, starts[not_empty]), ends[not_empty])
+    found = first_above < ends
+    # Like clear_bidding_curve, the first point is used when there is none and the previous point wraps around
+    idx_2 = np.where(found, first_above, starts)
+    idx_1 = np.where(idx_2 > starts, idx_2 - 1, ends - 1)
+    idx_2 = np.where(not_empty, idx_2, 0)
+    idx_1 = np.where(not_empty, idx_1, 0)
+    last = np.where(not_empty, ends - 1, 0)
+    first = np.where(not_empty, starts, 0)
+    y2, y1, x2, x1 = prices[idx_2], prices[idx_1], volumes[idx_2], volumes[idx_1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if producer:
+            cleared = x2 - ((y2 - spot) / (y2 - y1)) * (x2 - x1)
+            # If spot price is below smallest bidding price, assign 0 volume
+            cleared = np.where(idx_2 == starts, 0., cleared)
+            # If spot price is above (or equal to) biggest bidding price, assign biggest bidding volume
+            cleared = np.where(found & ~(spot > prices[last]), cleared, volumes[last])
+        else:
+            cleared = x2 - ((y1 - spot) / (y1 - y2)) * (x2 - x1)
+            # If spot price is above biggest bidding price, assign 0 volume
+            cleared = np.where(found, cleared, 0.)
+            # If spot price is under smallest bidding price, assign biggest bidding volume
+            cleared = np.where(spot < prices[first], volumes[first], cleared)
+    # Missing spot prices and empty curves cannot be cleared
+    return np.where(np.isnan(spot) | ~not_empty, np.nan, cleared)
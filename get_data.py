@@ -1,8 +1,18 @@
 import psycopg2
+import psycopg2.pool
+import numpy as np
 import pandas as pd
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from itertools import chain, islice
+from price_store import store_exists, read_prices, migrate_csv_to_store, list_regions, \
+    append_prices, truncate_prices, last_valid_date, read_watermarks, store_version, \
+    market_arrays, write_market_arrays, read_market_arrays, read_market_sources, write_market_sources
+from utils import compact_dtypes
 
 desired_width=320
 pd.set_option('display.width', desired_width)
@@ -18,174 +28,333 @@ with open(file_dir + '/paths.json') as f:
 data_directory = paths['data_directory']
 spot_prices_data_path = data_directory + '/' + paths['spot_prices_file_name']
 regulation_prices_data_path = data_directory + '/' + paths['regulation_prices_file_name']
+spot_prices_store_path = data_directory + '/' + paths['spot_prices_store_name']
+regulation_prices_store_path = data_directory + '/' + paths['regulation_prices_store_name']
+market_store_path = data_directory + '/' + paths['market_store_name']
 
-with open(file_dir + '/credentials.json') as f:
-    credentials = json.load(f)
-
-connection = psycopg2.connect(host='34.76.166.203',
-                              database=credentials['database'],
-                              user=credentials['username'],
-                              password=credentials['password'])
-cursor = connection.cursor()
+# The connections to the database are only opened on first use, and shared through a small pool
+default_database_host = '34.76.166.203'
+connection_pool_size = 4
+connection_pool = None
+connection_pool_lock = threading.Lock()
 
 if not os.path.exists(data_directory):
     os.makedirs(data_directory)
 
 
-
-
-def get_spot_prices():
-    new_df = pd.DataFrame(columns=['Region', 'Unit', 'Datetime', 'Spot_price'])
-
-    if os.path.exists(spot_prices_data_path):
+def database_parameters():
+    # Connection parameters of the database
+    # A full DSN can be given with the BACKTESTING_DSN environment variable or with a "dsn" key in credentials.json,
+    # otherwise the database, username, password and optional host and port keys of credentials.json are used.
+    if os.environ.get('BACKTESTING_DSN'):
+        return {'dsn': os.environ['BACKTESTING_DSN']}
+    with open(file_dir + '/credentials.json') as f:
+        credentials = json.load(f)
+    if 'dsn' in credentials:
+        return {'dsn': credentials['dsn']}
+    parameters = {'host': credentials.get('host', default_database_host),
+                  'database': credentials['database'],
+                  'user': credentials['username'],
+                  'password': credentials['password']}
+    if 'port' in credentials:
+        parameters['port'] = credentials['port']
+    return parameters
+
+def get_connection_pool():
+    global connection_pool
+    with connection_pool_lock:
+        if connection_pool is None:
+            connection_pool = psycopg2.pool.ThreadedConnectionPool(1, connection_pool_size, **database_parameters())
+    return connection_pool
+
+@contextmanager
+def database_connection():
+    # Borrow a connection from the pool, the transaction is committed (or rolled back on error) when it is given back
+    # Example call: with database_connection() as connection: ...
+    pool = get_connection_pool()
+    connection = pool.getconn()
+    try:
+        yield connection
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+
+def fetch_date_ranges(connection, table_name, first_date=None, chunk_days=365):
+    # Split the dates of a table, from first_date (or the first date of the table) to its last date,
+    # into ranges of chunk_days days, returned as (first date included, last date excluded) pairs
+    cursor = connection.cursor()
+    cursor.execute('select min(data_date), max(data_date) from {0};'.format(table_name))
+    min_date, max_date = cursor.fetchone()
+    cursor.close()
+    if max_date is None:
+        return []
+    first_date = pd.Timestamp(min_date if first_date is None else first_date).normalize()
+    end_date = pd.Timestamp(max_date).normalize() + timedelta(days=1)
+    starts = list(pd.date_range(first_date, end_date - timedelta(days=1), freq='{0}D'.format(chunk_days)))
+    return [(start.date(), end.date()) for start, end in zip(starts, starts[1:] + [end_date])]
+
+def query_price_rows(connection, table_name, condition, first_date, stream=False, batch_size=10000, chunk_days=365):
+    # Execute the query of the rows of a prices table from first_date, one range of chunk_days days at a time,
+    # and yield the executed cursors. With stream, server-side cursors are used.
+    for i, (chunk_first_date, chunk_end_date) in enumerate(fetch_date_ranges(connection, table_name, first_date, chunk_days)):
+        if stream:
+            query_cursor = connection.cursor(name='{0}_stream_{1}'.format(table_name, i))
+            query_cursor.itersize = batch_size
+        else:
+            query_cursor = connection.cursor()
+        query_cursor.execute('select * from {0} where data_date >= %s AND data_date < %s{1} order by data_date;'
+                             .format(table_name, condition), (chunk_first_date, chunk_end_date))
+        yield query_cursor
+        query_cursor.close()
+
+def update_prices(stream=False, batch_size=10000, chunk_days=365):
+    # Fetch the new spot prices and regulation prices concurrently, on separate connections
+    # The arguments have the same meaning as in get_spot_prices.
+    # The market arrays are then built again from the updated prices.
+    migrate_csv_prices()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        spot_prices = executor.submit(get_spot_prices, stream, batch_size, chunk_days)
+        regulation_prices = executor.submit(get_regulation_prices, stream, batch_size, chunk_days)
+        spot_prices, regulation_prices = spot_prices.result(), regulation_prices.result()
+    build_market_arrays()
+    return spot_prices, regulation_prices
+
+def get_spot_prices(stream=False, batch_size=10000, chunk_days=365):
+    # Fetch the new spot prices from the database and add them to the local price store
+    # Only the days from the high-water mark of the store are fetched, and only the rows after it are written,
+    # so that a refresh costs time proportional to the new data.
+    #
+    # --- Arguments description --
+    # Set stream to True to fetch the rows with a server-side cursor and write them to the store batch by batch,
+    # so that the memory used stays bounded whatever the length of the history. Nothing is returned in this mode,
+    # use load_spot_prices to read the data afterwards.
+    # batch_size is the number of rows (one row per region and day) fetched at once.
+    # The dates are queried by ranges of chunk_days days.
+    migrate_csv_prices(regulation=False)
+    watermarks = read_watermarks(spot_prices_store_path)
+    if watermarks:
         print("Updating spot prices.")
-        df = pd.read_csv(spot_prices_data_path, parse_dates=True, index_col=0)
-        df_last_date = pd.to_datetime(df.index[-1]).strftime('%Y-%m-%d')
-        cursor.execute("select * from regional_elspot where data_date >= '{0}';".format(df_last_date))
     else:
         print("Fetching spot prices.")
-        cursor.execute('select * from regional_elspot;')
-
-    regions, units, datetimes, spot_prices = spot_price_parse_results(cursor)
-    new_df['Datetime'] = datetimes
-    new_df['Region'] = regions
-    new_df['Unit'] = units
-    new_df['Spot_price'] = spot_prices
-    new_df = new_df.set_index('Datetime').sort_index()
-    if os.path.exists(spot_prices_data_path):
-        new_df = df.append(new_df)
-    new_df = new_df.sort_index()
+
+    new_dfs = []
+    with database_connection() as connection:
+        for query_cursor in query_price_rows(connection, 'regional_elspot', '',
+                                             min(watermarks.values()) if watermarks else None,
+                                             stream, batch_size, chunk_days):
+            for new_df in spot_price_batches(query_cursor, batch_size):
+                if stream:
+                    append_prices(new_df, spot_prices_store_path, watermarks)
+                else:
+                    new_dfs.append(new_df)
+    if not stream:
+        append_prices(pd.concat(new_dfs or [spot_price_frame([], [], [], [])]), spot_prices_store_path, watermarks)
 
     # Prune if there is a series of unvalid ref times at the end, data not available
     # Only the latest because we want to make the distinction between invalid and unavailable
-    new_df = new_df[:new_df[new_df['Spot_price'] != -1].index[-1]]
-
-    new_df.to_csv(spot_prices_data_path)
-
-    return new_df
-
-def spot_price_parse_results(cursor):
-    regions = []
-    units = []
-    datetimes = []
-    spot_prices = []
-    for query in cursor:
-
-        region = query[0]
-        unit = query[1]
-        data_date = query[2]
-        # fetch_date = query[3]
-        # total = query[4]
-        prices = query[5]
-
-        for i, price in enumerate(prices):
-            datetime = pd.to_datetime(data_date) + timedelta(hours=i)
-            regions.append(region)
-            units.append(unit)
-            datetimes.append(datetime)
-            spot_prices.append(price)
-
-    return regions, units, datetimes, spot_prices
-
-def get_regulation_prices():
-    new_df = pd.DataFrame(columns=['Region', 'Unit', 'Datetime', 'Upregulation_price', 'Downregulation_price', 'Dominating_direction'])
-
-    if os.path.exists(regulation_prices_data_path):
+    truncate_prices(spot_prices_store_path, last_valid_date(spot_prices_store_path, 'Spot_price'))
+
+    if not stream:
+        return read_prices(spot_prices_store_path)
+
+def fetch_batches(cursor, batch_size=10000):
+    # Iterate over the rows returned by an executed query, batch_size rows at a time
+    # Any iterable of rows (e.g. a list of tuples) can be used instead of a psycopg2 cursor
+    if hasattr(cursor, 'fetchmany'):
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    else:
+        rows = iter(cursor)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+def expand_daily_prices(data_dates, daily_prices):
+    # Expand the daily arrays of prices (one price per market time unit from 0 am) to one datetime and one price per unit
+    # Example call: datetimes, prices, row_positions = expand_daily_prices(['2019-03-25'], [[31.2, 30.5, ...]])
+    # row_positions gives for each unit the position of the daily array it comes from
+    # The time unit of every array is deduced from its length: 24 prices (23 or 25 on the days of the daylight
+    # saving time changes) are hourly prices, 96 prices (92 or 100) are 15-minute prices, and so on.
+    lengths = np.array([len(prices) for prices in daily_prices], dtype=np.int64)
+    row_positions = np.repeat(np.arange(len(daily_prices)), lengths)
+    units = np.arange(len(row_positions)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    units_per_hour = np.maximum(np.round(lengths / 24.), 1).astype(np.int64)
+    unit_minutes = (60 // units_per_hour)[row_positions]
+    datetimes = pd.to_datetime(pd.Series(data_dates)).values.astype('datetime64[ns]')[row_positions] \
+                + (units * unit_minutes).astype('timedelta64[m]')
+    prices = np.array(list(chain.from_iterable(daily_prices)), dtype=np.float64)
+    return datetimes, prices, row_positions
+
+def spot_price_batches(cursor, batch_size=10000):
+    # Yield the spot prices returned by the cursor as dataframes of at most batch_size days (per region)
+    for rows in fetch_batches(cursor, batch_size):
+        yield spot_price_frame(*spot_price_parse_results(rows))
+
+def spot_price_frame(regions, units, datetimes, spot_prices):
+    new_df = pd.DataFrame({'Region': regions, 'Unit': units, 'Spot_price': spot_prices},
+                          columns=['Region', 'Unit', 'Spot_price'],
+                          index=pd.DatetimeIndex(datetimes, name='Datetime'))
+    return new_df.sort_index(kind='mergesort')
+
+def spot_price_parse_results(rows):
+    # Columns of the regional_elspot table: region, unit, data_date, fetch_date, total, prices
+    rows = list(rows)
+    regions = np.array([query[0] for query in rows], dtype=object)
+    units = np.array([query[1] for query in rows], dtype=object)
+    datetimes, spot_prices, row_positions = expand_daily_prices([query[2] for query in rows],
+                                                                [query[5] for query in rows])
+
+    return regions[row_positions], units[row_positions], datetimes, spot_prices
+
+def get_regulation_prices(stream=False, batch_size=10000, chunk_days=365):
+    # Fetch the new regulation prices from the database and add them to the local price store
+    #
+    # --- Arguments description --
+    # The arguments have the same meaning as in get_spot_prices.
+    migrate_csv_prices(spot=False)
+    watermarks = read_watermarks(regulation_prices_store_path)
+    if watermarks:
         print("Updating regulation prices.")
-        df = pd.read_csv(regulation_prices_data_path, parse_dates=True, index_col=0)
-        df_last_date = df.index[-1].strftime('%Y-%m-%d')
-        cursor.execute("select * from regional_regulating where data_date >= '{0}' AND reg_code IN ('RO', 'RN', 'DD');".format(df_last_date))
     else:
         print("Fetching regulation prices.")
-        cursor.execute("select * from regional_regulating where reg_code IN ('RO', 'RN', 'DD');")
-
-    datetimes_dd, area_codes_dd, reg_prices_dd, \
-    datetimes_ro, area_codes_ro, reg_prices_ro, \
-    datetimes_rn, area_codes_rn, reg_prices_rn = reg_price_parse_results(cursor)
 
-    df_dd = pd.DataFrame(columns=['Datetime', 'Region', 'Dominating_direction'])
-    df_dd['Datetime'] = datetimes_dd
-    df_dd['Region'] = area_codes_dd
-    df_dd['Dominating_direction'] = reg_prices_dd
+    new_dfs = []
+    with database_connection() as connection:
+        for query_cursor in query_price_rows(connection, 'regional_regulating', " AND reg_code IN ('RO', 'RN', 'DD')",
+                                             min(watermarks.values()) if watermarks else None,
+                                             stream, batch_size, chunk_days):
+            for new_df in reg_price_batches(query_cursor, batch_size):
+                if stream:
+                    append_prices(new_df, regulation_prices_store_path, watermarks)
+                else:
+                    new_dfs.append(new_df)
+    if not stream:
+        append_prices(pd.concat(new_dfs or [reg_price_frame(*reg_price_parse_results([]))]),
+                      regulation_prices_store_path, watermarks)
 
-    df_ro = pd.DataFrame(columns=['Datetime', 'Region', 'Upregulation_price'])
-    df_ro['Datetime'] = datetimes_ro
-    df_ro['Region'] = area_codes_ro
-    df_ro['Upregulation_price'] = reg_prices_ro
-
-
-    df_rn = pd.DataFrame(columns=['Datetime', 'Region', 'Downregulation_price'])
-    df_rn['Datetime'] = datetimes_rn
-    df_rn['Region'] = area_codes_rn
-    df_rn['Downregulation_price'] = reg_prices_rn
+    # Prune if there is a series of unvalid ref times at the end, data not available
+    # Only the latest because we want to make the distinction between invalid and unavailable
+    truncate_prices(regulation_prices_store_path, last_valid_date(regulation_prices_store_path, 'Upregulation_price'))
+    truncate_prices(regulation_prices_store_path, last_valid_date(regulation_prices_store_path, 'Downregulation_price'))
+
+    if not stream:
+        return read_prices(regulation_prices_store_path)
+
+def reg_price_batches(cursor, batch_size=10000):
+    # Yield the regulation prices returned by the cursor (sorted by data_date) as dataframes.
+    # The RO, RN and DD rows of the same day have to be merged together, so the rows of the last day of each batch
+    # are kept for the next batch, as they may continue there.
+    pending_rows = []
+    for rows in fetch_batches(cursor, batch_size):
+        rows = pending_rows + list(rows)
+        last_date = max(query[1] for query in rows)
+        pending_rows = [query for query in rows if query[1] == last_date]
+        rows = [query for query in rows if query[1] != last_date]
+        if rows:
+            yield reg_price_frame(*reg_price_parse_results(rows))
+    if pending_rows:
+        yield reg_price_frame(*reg_price_parse_results(pending_rows))
+
+def reg_price_frame(datetimes_dd, area_codes_dd, reg_prices_dd,
+                    datetimes_ro, area_codes_ro, reg_prices_ro,
+                    datetimes_rn, area_codes_rn, reg_prices_rn):
+    # Merge the dominating direction, upregulation and downregulation prices in one dataframe
+    df_dd = pd.DataFrame({'Datetime': datetimes_dd, 'Region': area_codes_dd, 'Dominating_direction': reg_prices_dd},
+                         columns=['Datetime', 'Region', 'Dominating_direction'])
+    df_ro = pd.DataFrame({'Datetime': datetimes_ro, 'Region': area_codes_ro, 'Upregulation_price': reg_prices_ro},
+                         columns=['Datetime', 'Region', 'Upregulation_price'])
+    df_rn = pd.DataFrame({'Datetime': datetimes_rn, 'Region': area_codes_rn, 'Downregulation_price': reg_prices_rn},
+                         columns=['Datetime', 'Region', 'Downregulation_price'])
 
     new_df = df_rn.merge(df_ro, left_on=['Datetime', 'Region'], right_on=['Datetime', 'Region'])
     new_df = new_df.merge(df_dd, left_on=['Datetime', 'Region'], right_on=['Datetime', 'Region'])
     new_df['Unit'] = 'EUR'
-    new_df = new_df.set_index('Datetime').sort_index()
-    if os.path.exists(regulation_prices_data_path):
-        new_df = df.append(new_df)
-    new_df = new_df.sort_index()
-
-
-    # Prune if there is a series of unvalid ref times at the end, data not available
-    # Only the latest because we want to make the distinction between invalid and unavailable
-    new_df = new_df[:new_df[new_df['Upregulation_price'] != -1].index[-1]]
-    new_df = new_df[:new_df[new_df['Downregulation_price'] != -1].index[-1]]
-
-    new_df.to_csv(regulation_prices_data_path)
-
-    return new_df
-
-def reg_price_parse_results(cursor):
-    datetimes_dd = []
-    datetimes_ro = []
-    datetimes_rn = []
-
-    area_codes_dd = []
-    area_codes_ro = []
-    area_codes_rn = []
-
-    reg_prices_dd = []
-    reg_prices_ro = []
-    reg_prices_rn = []
-
-    for query in cursor:
-        area_code = query[0]
-        data_date = query[1]
-        #fetch_date = query[2]
-        #total=query[3]
-        prices = query[4]
-        # reg_type = query[5]
-        reg_code = query[6]
-
-        # If this row only indicates the dominating direction
-        if reg_code == 'DD':
-            for i, price in enumerate(prices):
-                datetime = pd.to_datetime(data_date) + timedelta(hours=i)
-                datetimes_dd.append(datetime)
-                area_codes_dd.append(area_code)
-                reg_prices_dd.append(price)
-
-        elif reg_code == 'RO':
-            for i, price in enumerate(prices):
-                datetime = pd.to_datetime(data_date) + timedelta(hours=i)
-                datetimes_ro.append(datetime)
-                area_codes_ro.append(area_code)
-                reg_prices_ro.append(price)
-
-        elif reg_code == 'RN':
-            for i, price in enumerate(prices):
-                datetime = pd.to_datetime(data_date) + timedelta(hours=i)
-                datetimes_rn.append(datetime)
-                area_codes_rn.append(area_code)
-                reg_prices_rn.append(price)
-
-    return datetimes_dd, area_codes_dd, reg_prices_dd,\
-           datetimes_ro, area_codes_ro, reg_prices_ro,\
-           datetimes_rn, area_codes_rn, reg_prices_rn
-
-def get_range_prices(first_date, last_date, update=False, separate_df=True):
+    return new_df.set_index('Datetime').sort_index()
+
+def reg_price_parse_results(rows):
+    # Columns of the regional_regulating table: area_code, data_date, fetch_date, total, prices, reg_type, reg_code
+    rows = list(rows)
+    area_codes = np.array([query[0] for query in rows], dtype=object)
+    reg_codes = np.array([query[6] for query in rows], dtype=object)
+    datetimes, reg_prices, row_positions = expand_daily_prices([query[1] for query in rows],
+                                                               [query[4] for query in rows])
+    area_codes = area_codes[row_positions]
+    reg_codes = reg_codes[row_positions]
+
+    # DD rows only indicate the dominating direction, RO rows are upregulation prices and RN downregulation prices
+    dd = reg_codes == 'DD'
+    ro = reg_codes == 'RO'
+    rn = reg_codes == 'RN'
+    directions = reg_prices[dd]
+    if not np.isnan(directions).any():
+        directions = directions.astype(np.int64)
+
+    return datetimes[dd], area_codes[dd], directions,\
+           datetimes[ro], area_codes[ro], reg_prices[ro],\
+           datetimes[rn], area_codes[rn], reg_prices[rn]
+
+def migrate_csv_prices(spot=True, regulation=True):
+    # One-time migration of the CSV files used by the previous versions to the binary price store
+    # Nothing is done if the store already exists or if there is no CSV file to migrate
+    if spot and not store_exists(spot_prices_store_path) and os.path.exists(spot_prices_data_path):
+        print("Migrating spot prices to the price store.")
+        migrate_csv_to_store(spot_prices_data_path, spot_prices_store_path)
+    if regulation and not store_exists(regulation_prices_store_path) and os.path.exists(regulation_prices_data_path):
+        print("Migrating regulation prices to the price store.")
+        migrate_csv_to_store(regulation_prices_data_path, regulation_prices_store_path)
+
+def load_spot_prices(regions=None, first_date=None, last_date=None):
+    # Load the local spot prices, only reading the given regions and range of dates (both included)
+    # Example call: load_spot_prices(['SE1'], '2019-03-25', '2019-03-30')
+    migrate_csv_prices(regulation=False)
+    return read_prices(spot_prices_store_path, regions, first_date, last_date)
+
+def load_regulation_prices(regions=None, first_date=None, last_date=None):
+    # Load the local regulation prices, only reading the given regions and range of dates (both included)
+    # Example call: load_regulation_prices(['SE1'], '2019-03-25', '2019-03-30')
+    migrate_csv_prices(spot=False)
+    return read_prices(regulation_prices_store_path, regions, first_date, last_date)
+
+def build_market_arrays():
+    # Join and clean the spot and regulation prices of every region once, and save them as market arrays
+    # (see price_store.market_arrays), so that the backtests do not have to merge them at each call
+    migrate_csv_prices()
+    sources = [list(version) if version else None for version in price_store_version()]
+    regions = sorted(set(list_regions(spot_prices_store_path)) & set(list_regions(regulation_prices_store_path))) \
+        if store_exists(spot_prices_store_path) and store_exists(regulation_prices_store_path) else []
+    for region in regions:
+        write_market_arrays(market_store_path, region,
+                            market_arrays(read_prices(spot_prices_store_path, [region]),
+                                          read_prices(regulation_prices_store_path, [region])))
+    write_market_sources(market_store_path, sources)
+
+def update_market_arrays():
+    # Build the market arrays again if the local prices changed since they were built
+    # Call it before starting processes which load the market arrays, so that they do not all build them at once
+    sources = [list(version) if version else None for version in price_store_version()]
+    if read_market_sources(market_store_path) != sources:
+        build_market_arrays()
+
+def load_market_arrays(region, first_date=None, last_date=None):
+    # Memory-map the market arrays of a region for a range of dates (both included)
+    # The arrays are built again first if the local prices changed since they were built
+    # Example call: arrays = load_market_arrays('SE1', '2019-03-25', '2019-03-30')
+    update_market_arrays()
+    return read_market_arrays(market_store_path, region, first_date, last_date)
+
+def price_store_version():
+    # Token changing each time the local spot or regulation prices are written, used to invalidate caches
+    return store_version(spot_prices_store_path), store_version(regulation_prices_store_path)
+
+def get_range_prices(first_date, last_date, update=False, separate_df=True, compact=False, float32_prices=False):
     # Get prices data for a specific range of dates
     # Example call: get_range_prices('2019-03-25','2019-03-30', separate_df=False)
     #
@@ -195,23 +364,23 @@ def get_range_prices(first_date, last_date, update=False, separate_df=True):
     # Set update to True if you want to refresh your data, slows down the response time
     # Set separate_df to True if you want one dataframe for the spot prices and one for the regulation prices
     # Set separate_df to False (or don't provide it) if you want all the prices in the same dataframe
+    # Set compact to True to save memory with categorical Region and Unit columns and an int8 dominating direction,
+    # and float32_prices to True to also store the prices as float32 (see utils.compact_dtypes)
 
     if update:
-        spot = get_spot_prices()
-        reg = get_regulation_prices()
-    else:
-        spot = pd.read_csv(spot_prices_data_path, parse_dates=True, index_col=0)
-        reg = pd.read_csv(regulation_prices_data_path, parse_dates=True, index_col=0)
-
-    spot = spot[pd.to_datetime(first_date):pd.to_datetime(last_date)]
-
-    reg = reg[pd.to_datetime(first_date):pd.to_datetime(last_date)]
+        update_prices(stream=True)
+    spot = load_spot_prices(first_date=first_date, last_date=last_date)
+    reg = load_regulation_prices(first_date=first_date, last_date=last_date)
 
     if separate_df:
+        if compact or float32_prices:
+            return compact_dtypes(spot, float32_prices), compact_dtypes(reg, float32_prices)
         return spot, reg
     else:
         cols_to_use = set(reg.columns) - set(spot.columns)
         spot = spot.merge(reg[list(cols_to_use) + ['Region']], left_on=['Datetime', 'Region'], right_on=['Datetime','Region'])
+        if compact or float32_prices:
+            return compact_dtypes(spot, float32_prices)
         return spot
 
 
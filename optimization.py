@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+from backtesting import load_market_data
+from clearing import clear_bidding_curve
+from settlement import imbalance_errors, imbalance_cost
+
+
+def evaluation_market(region, forecast, production, update=True, convert_to_utc=False):
+    # Market data of the hours of the forecast merged with the forecast and the actual production,
+    # as used by evaluate_bidding_curves and optimize_bidding_curve
+    # Example call: market = evaluation_market('SE1', forecast, production, update=False)
+    #
+    # forecast and production are production dataframes (see backtesting_function) with the forecasted and the
+    # actual production. Only the hours with prices, forecast and production are kept, at the time unit of the forecast
+    # (see load_market_data).
+    data = load_market_data(region, forecast.index, update, convert_to_utc)
+    data = data[['Spot_price', 'Upregulation_price', 'Downregulation_price', 'Dominating_direction']]
+    forecast = forecast['Production'] if isinstance(forecast, pd.DataFrame) else forecast
+    production = production['Production'] if isinstance(production, pd.DataFrame) else production
+    data = data.join(forecast.rename('Forecast'), how='inner').join(production.rename('Production'), how='inner')
+    return data.dropna(subset=['Forecast', 'Production'])
+
+
+def evaluate_bidding_curves(market, bid_prices, bid_volumes, one_price=False, producer=True, batch_size=256):
+    # Total profit of many candidate bidding curves over the hours of the market data, in batched passes
+    # Example call: profits = evaluate_bidding_curves(market, bid_prices, bid_volumes)
+    #
+    # --- Arguments description --
+    # market is the dataframe returned by evaluation_market.
+    # bid_prices and bid_volumes have the shape (candidates, hours, points), the hours being the rows of market.
+    # The hours axis can have a length of 1 to use the same curve for all the hours.
+    # The candidates are cleared and settled batch_size at a time to bound the memory used.
+    # The profits are computed with the same equations as backtesting_function (nan hours are skipped).
+    spot_price = market['Spot_price'].to_numpy(dtype=np.float64)
+    upregulation_price = market['Upregulation_price'].to_numpy(dtype=np.float64)
+    downregulation_price = market['Downregulation_price'].to_numpy(dtype=np.float64)
+    dominating_direction = market['Dominating_direction'].to_numpy()
+    production = market['Production'].to_numpy(dtype=np.float64)
+    bid_prices = np.asarray(bid_prices, dtype=np.float64)
+    bid_volumes = np.asarray(bid_volumes, dtype=np.float64)
+    n_candidates = max(bid_prices.shape[0], bid_volumes.shape[0])
+    shape = (n_candidates, len(spot_price), max(bid_prices.shape[-1], bid_volumes.shape[-1]))
+    bid_prices = np.broadcast_to(bid_prices, shape)
+    bid_volumes = np.broadcast_to(bid_volumes, shape)
+
+    profits = np.empty(n_candidates)
+    for first in range(0, n_candidates, batch_size):
+        batch = slice(first, first + batch_size)
+        volume = clear_bidding_curve(spot_price, bid_prices[batch], bid_volumes[batch], producer)
+        e_plus, e_minus = imbalance_errors(production, volume)
+        cost = imbalance_cost(spot_price, upregulation_price, downregulation_price, dominating_direction,
+                              e_plus, e_minus, one_price)
+        profits[batch] = np.nansum(spot_price * volume + cost, axis=-1)
+    return profits
+
+
+def optimize_bidding_curve(region,
+                           forecast,
+                           production,
+                           points=4,
+                           one_price=False,
+                           producer=True,
+                           update=True,
+                           convert_to_utc=False,
+                           by_hour=True,
+                           candidates=1000,
+                           iterations=20,
+                           elite_fraction=0.1,
+                           max_volume_ratio=2.,
+                           seed=0):
+    # Search the bidding curve maximizing the historical profit of a region, for the given production forecasts.
+    # Example call: bidding_curve = optimize_bidding_curve('SE1', forecast, production, update=False)
+    #
+    # ------ Search space ----------
+    # The curve of an hour has points bid prices (sorted, between the smallest and the largest historical spot prices)
+    # and points bid volumes given as ratios of the production forecast of the hour (sorted, between 0 and
+    # max_volume_ratio), so that the curves are monotonically increasing as required by backtesting_function.
+    # With by_hour, one set of prices and ratios is searched for every hour of the day, otherwise one for all the hours.
+    #
+    # ------ Search ----------
+    # Cross-entropy method: at every iteration, candidates curves are drawn from normal distributions around the
+    # current means, scored at once with evaluate_bidding_curves, and the means and standard deviations are updated
+    # from the elite_fraction best ones. seed makes the search reproducible.
+    # The other parameters have the same meaning as in backtesting_function.
+    #
+    # ------ Output ----------
+    # The best bidding curve for the hours of the forecast (wide dataframe, see backtesting_function).
+    # backtesting_function(region, bidding_curve, production, ...) gives its profit with the historical prices.
+    market = evaluation_market(region, forecast, production, update, convert_to_utc)
+    forecast = forecast['Production'] if isinstance(forecast, pd.DataFrame) else forecast
+    rng = np.random.RandomState(seed)
+    n_elite = max(int(candidates * elite_fraction), 2)
+    groups = forecast.index.hour if by_hour else np.zeros(len(forecast), dtype=np.int64)
+    market_groups = market.index.hour if by_hour else np.zeros(len(market), dtype=np.int64)
+
+    best = {}
+    for group in np.unique(groups):
+        group_market = market[market_groups == group]
+        if len(group_market) == 0:
+            continue
+        low, high = group_market['Spot_price'].min(), group_market['Spot_price'].max()
+        means = np.concatenate([np.linspace(low, high, points), np.linspace(0, max_volume_ratio, points)])
+        stds = np.concatenate([np.full(points, (high - low) / 2. + 1.), np.full(points, max_volume_ratio / 2.)])
+        group_forecast = group_market['Forecast'].to_numpy(dtype=np.float64)
+        best_profit = -np.inf
+        for _ in range(iterations):
+            samples = means + stds * rng.standard_normal((candidates, 2 * points))
+            # Prices strictly increasing (by at least 0.01 €/MWh) and volumes increasing
+            bid_prices = np.sort(np.clip(samples[:, :points], low - 1., high + 1.), axis=1) + 0.01 * np.arange(points)
+            ratios = np.sort(np.clip(samples[:, points:], 0., max_volume_ratio), axis=1)
+            profits = evaluate_bidding_curves(group_market, bid_prices[:, np.newaxis, :],
+                                              ratios[:, np.newaxis, :] * group_forecast[np.newaxis, :, np.newaxis],
+                                              one_price, producer)
+            elite = np.argsort(profits)[::-1][:n_elite]
+            if profits[elite[0]] > best_profit:
+                best_profit = profits[elite[0]]
+                best[group] = (bid_prices[elite[0]], ratios[elite[0]])
+            elite_samples = np.concatenate([bid_prices[elite], ratios[elite]], axis=1)
+            means = elite_samples.mean(axis=0)
+            stds = elite_samples.std(axis=0) + 1e-6
+
+    # Bidding curve of every hour of the forecast from the best prices and ratios of its group
+    curves = np.full((len(forecast), points, 2), np.nan)
+    for group, (bid_prices, ratios) in best.items():
+        hours = np.asarray(groups == group)
+        curves[hours, :, 0] = bid_prices
+        curves[hours, :, 1] = ratios * forecast.to_numpy(dtype=np.float64)[hours, np.newaxis]
+    columns = [col_name for i in range(points) for col_name in ('bid_price_' + str(i + 1), 'bid_volume_' + str(i + 1))]
+    return pd.DataFrame(curves.reshape(len(forecast), 2 * points), columns=columns, index=forecast.index)
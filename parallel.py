@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from clearing import clear_bidding_curve
+from settlement import imbalance_errors, imbalance_cost
+
+# Columns computed by settle_arrays, in the order of backtesting_function, and column of the shared results
+# set to 1 for the rows settled by the workers
+RESULT_COLUMNS = ['Imbalance_cost', 'Profit', 'Profit_no_error', 'Optimization_ratio']
+SETTLED_COLUMN = 'Settled'
+
+
+def shared_directory():
+    # Temporary directory for the arrays shared with the worker processes,
+    # in memory (/dev/shm) when the system provides it
+    return tempfile.mkdtemp(prefix='backtesting_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+def remove_shared_directory(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def share_array(directory, name, array):
+    # Save an array in the shared directory and return its path.
+    # The workers memory-map it, so that all the processes read the same pages instead of a pickled copy.
+    path = os.path.join(directory, name + '.npy')
+    np.save(path, np.ascontiguousarray(array))
+    return path
+
+
+def shared_result(directory, name, length):
+    # Create a float array filled with nan in the shared directory, written in place by the workers
+    path = os.path.join(directory, name + '.npy')
+    result = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(length,))
+    result[:] = np.nan
+    result.flush()
+    return path
+
+
+def settle_arrays(spot_price, upregulation_price, downregulation_price, dominating_direction, production,
+                  bid_prices, bid_volumes, one_price=False, producer=True, optimal=False):
+    # Clear and settle the hours of a chunk given as arrays (one row per hour), and return the result columns
+    volume = clear_bidding_curve(spot_price, bid_prices, bid_volumes, producer)
+    e_plus, e_minus = imbalance_errors(production, volume)
+    results = {'Imbalance_cost': imbalance_cost(spot_price, upregulation_price, downregulation_price,
+                                                dominating_direction, e_plus, e_minus, one_price)}
+    results['Profit'] = spot_price * volume + results['Imbalance_cost']
+    if optimal:
+        results['Profit_no_error'] = production * spot_price
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results['Optimization_ratio'] = results['Profit'] / results['Profit_no_error']
+    return results
+
+
+def write_results(paths, positions, results):
+    # Write the result columns of a chunk in place at the given rows of the shared result arrays,
+    # and mark these rows as settled
+    results = dict(results)
+    results[SETTLED_COLUMN] = np.ones(len(positions))
+    for col_name, values in results.items():
+        output = np.load(paths[col_name], mmap_mode='r+')
+        output[positions] = values
+        output.flush()
+        del output
@@ -0,0 +1,382 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from utils import time_resolution
+
+# Binary columnar store for the price histories.
+# Each series (spot prices, regulation prices) is saved in its own directory, split by region and by month,
+# with one .npy file per column so that the files can be memory-mapped and only the needed partitions are read:
+#
+#   <store_path>/columns.json
+#   <store_path>/manifest.json
+#   <store_path>/<region>/<YYYY-MM>/Datetime.npy
+#   <store_path>/<region>/<YYYY-MM>/<column>.npy
+#
+# The manifest keeps, for each region, the high-water mark (last datetime stored) and the number of rows,
+# as well as a version number increased at each write, so that updates only have to write the new rows.
+#
+# The market arrays are the spot and regulation prices of each region already joined and cleaned,
+# saved as contiguous arrays sorted by datetime so that a backtest can align them with a binary search:
+#
+#   <market_path>/market.json
+#   <market_path>/<region>/<column>.npy
+#
+# market.json keeps the versions of the price stores the arrays were built from and the version of their format,
+# so that the arrays are built again when either changes.
+
+COLUMNS_FILE_NAME = 'columns.json'
+MANIFEST_FILE_NAME = 'manifest.json'
+MARKET_FILE_NAME = 'market.json'
+INDEX_NAME = 'Datetime'
+
+# Columns of the market arrays, and bits of the Validity bitmask (set when the price is not the -1 sentinel,
+# and when the dominating direction is known, the int8 direction being 0 otherwise)
+MARKET_COLUMNS = ['Unit', 'Spot_price', 'Upregulation_price', 'Downregulation_price', 'Dominating_direction', 'Validity']
+MARKET_FORMAT = 2
+VALID_SPOT_PRICE = 1
+VALID_UPREGULATION_PRICE = 2
+VALID_DOWNREGULATION_PRICE = 4
+VALID_DOMINATING_DIRECTION = 8
+VALID_PRICES = VALID_SPOT_PRICE | VALID_UPREGULATION_PRICE | VALID_DOWNREGULATION_PRICE
+
+
+def store_exists(store_path):
+    return os.path.exists(os.path.join(store_path, COLUMNS_FILE_NAME))
+
+
+def write_prices(df, store_path):
+    # Write a prices dataframe (Datetime index, one Region column) to the store, replacing its previous content
+    # Example call: write_prices(spot_prices, 'data/spot_prices')
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    write_partitions(df, store_path, append=False, watermarks={})
+
+
+def append_prices(df, store_path, watermarks=None):
+    # Add the new rows of a prices dataframe to the store, only rewriting the partitions (region and month) they belong to
+    # Example call: append_prices(new_spot_prices, 'data/spot_prices')
+    # The rows which are not after the high-water mark of their region are already stored and are dropped,
+    # as well as the duplicated rows (same datetime and unit) in the new data.
+    # When an update is written in several batches, the high-water marks read before the first batch
+    # (see read_watermarks) should be provided for all of them.
+    if watermarks is None:
+        watermarks = read_watermarks(store_path)
+    write_partitions(df, store_path, append=True, watermarks=watermarks)
+
+
+def write_partitions(df, store_path, append, watermarks):
+    if not store_exists(store_path):
+        os.makedirs(store_path, exist_ok=True)
+        with open(os.path.join(store_path, COLUMNS_FILE_NAME), 'w') as f:
+            json.dump({'columns': list(df.columns)}, f)
+    columns = list(df.columns)
+    manifest = read_manifest(store_path)
+
+    datetimes = pd.DatetimeIndex(df.index).values.astype('datetime64[ns]')
+    regions = df['Region'].astype(str).values
+    for region in np.unique(regions):
+        region_manifest = manifest['regions'].setdefault(region, {'last_date': None, 'rows': 0})
+        region_positions = np.flatnonzero(regions == region)
+        if region in watermarks:
+            # Only keep the rows after the high-water mark
+            watermark = watermarks[region].to_datetime64().astype('datetime64[ns]')
+            region_positions = region_positions[datetimes[region_positions] > watermark]
+        # Partitions are sorted by datetime, keeping the original order of the rows with the same datetime
+        region_positions = region_positions[np.argsort(datetimes[region_positions], kind='stable')]
+        region_datetimes = datetimes[region_positions]
+        months, month_starts = np.unique(region_datetimes.astype('datetime64[M]'), return_index=True)
+        month_ends = np.append(month_starts[1:], len(region_positions))
+        for month, month_start, month_end in zip(months, month_starts, month_ends):
+            partition_path = os.path.join(store_path, region, str(month))
+            partition = df.iloc[region_positions[month_start:month_end]][columns]
+            stored_rows = 0
+            if append and os.path.exists(os.path.join(partition_path, INDEX_NAME + '.npy')):
+                stored = read_partition(partition_path, columns, region)
+                stored_rows = len(stored)
+                partition = pd.concat([stored, partition])
+                partition = partition.iloc[np.argsort(partition.index.values, kind='stable')]
+            partition = partition[~duplicated_rows(partition)]
+            write_partition(partition_path, pd.DatetimeIndex(partition.index).values.astype('datetime64[ns]'),
+                            partition)
+            region_manifest['rows'] += len(partition) - stored_rows
+            region_manifest['last_date'] = max_date(region_manifest['last_date'], partition.index[-1])
+    write_manifest(store_path, manifest)
+
+
+def duplicated_rows(df):
+    # Rows with the same datetime (and unit) as a previous row, the first one being kept
+    keys = pd.DataFrame({INDEX_NAME: df.index.values})
+    if 'Unit' in df.columns:
+        keys['Unit'] = df['Unit'].values
+    return keys.duplicated(keep='first').values
+
+
+def max_date(last_date, date):
+    date = pd.Timestamp(date)
+    if last_date is not None and pd.Timestamp(last_date) > date:
+        return last_date
+    return date.isoformat()
+
+
+def read_manifest(store_path):
+    # Read the manifest of the store, rebuilding it from the partitions if it does not exist (e.g. after a migration)
+    manifest_path = os.path.join(store_path, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    manifest = {'version': 0, 'regions': {}}
+    if not os.path.exists(store_path):
+        return manifest
+    for region in list_regions(store_path):
+        region_manifest = {'last_date': None, 'rows': 0}
+        for month in sorted(os.listdir(os.path.join(store_path, region))):
+            datetimes = np.load(os.path.join(store_path, region, month, INDEX_NAME + '.npy'), mmap_mode='r')
+            region_manifest['rows'] += len(datetimes)
+            if len(datetimes):
+                region_manifest['last_date'] = max_date(region_manifest['last_date'], datetimes[-1])
+        manifest['regions'][region] = region_manifest
+    return manifest
+
+
+def write_manifest(store_path, manifest):
+    manifest['version'] = manifest.get('version', 0) + 1
+    manifest_path = os.path.join(store_path, MANIFEST_FILE_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def store_version(store_path):
+    # Token changing at each write of the store (None if the store does not exist)
+    # The manifest is replaced at each write, so its inode and modification time are enough and no file is read
+    try:
+        manifest_stat = os.stat(os.path.join(store_path, MANIFEST_FILE_NAME))
+    except FileNotFoundError:
+        return None
+    return manifest_stat.st_ino, manifest_stat.st_mtime_ns
+
+
+def read_watermarks(store_path):
+    # High-water mark (last datetime stored) of each region of the store
+    return {region: pd.Timestamp(region_manifest['last_date'])
+            for region, region_manifest in read_manifest(store_path)['regions'].items()
+            if region_manifest['last_date'] is not None}
+
+
+def truncate_prices(store_path, last_date):
+    # Delete the rows of the store after last_date (included in the rows kept)
+    if last_date is None:
+        return
+    last_date = pd.to_datetime(last_date).to_datetime64().astype('datetime64[ns]')
+    with open(os.path.join(store_path, COLUMNS_FILE_NAME)) as f:
+        columns = json.load(f)['columns']
+    manifest = read_manifest(store_path)
+    truncated = False
+    for region in list_regions(store_path):
+        region_path = os.path.join(store_path, region)
+        region_manifest = manifest['regions'].setdefault(region, {'last_date': None, 'rows': 0})
+        for month in sorted(os.listdir(region_path)):
+            month_start = np.datetime64(month, 'M')
+            if month_start < last_date.astype('datetime64[M]'):
+                continue
+            partition_path = os.path.join(region_path, month)
+            stored_datetimes = np.load(os.path.join(partition_path, INDEX_NAME + '.npy'), mmap_mode='r')
+            stored_rows = len(stored_datetimes)
+            if stored_rows and stored_datetimes[-1] <= last_date:
+                continue
+            truncated = True
+            if month_start > last_date.astype('datetime64[M]'):
+                shutil.rmtree(partition_path)
+                region_manifest['rows'] -= stored_rows
+            else:
+                partition = read_partition(partition_path, columns, region, last_date=last_date)
+                if len(partition):
+                    write_partition(partition_path, partition.index.values.astype('datetime64[ns]'), partition)
+                else:
+                    shutil.rmtree(partition_path)
+                region_manifest['rows'] -= stored_rows - len(partition)
+        # The high-water mark is moved back to the last row kept
+        region_manifest['last_date'] = None
+        months = sorted(os.listdir(region_path))
+        if months:
+            datetimes = np.load(os.path.join(region_path, months[-1], INDEX_NAME + '.npy'), mmap_mode='r')
+            region_manifest['last_date'] = pd.Timestamp(datetimes[-1]).isoformat()
+    if truncated:
+        write_manifest(store_path, manifest)
+
+
+def last_valid_date(store_path, col_name, invalid_value=-1):
+    # Last datetime with a valid value in the given column, over all the regions
+    # Only the last partitions of each region are read, until a valid value is found
+    dates = []
+    for region in list_regions(store_path):
+        region_path = os.path.join(store_path, region)
+        for month in sorted(os.listdir(region_path), reverse=True):
+            values = np.load(os.path.join(region_path, month, col_name + '.npy'), mmap_mode='r')
+            valid = np.flatnonzero(values != invalid_value)
+            if len(valid):
+                datetimes = np.load(os.path.join(region_path, month, INDEX_NAME + '.npy'), mmap_mode='r')
+                dates.append(datetimes[valid[-1]])
+                break
+    return pd.Timestamp(max(dates)) if dates else None
+
+
+def list_regions(store_path):
+    return sorted(name for name in os.listdir(store_path) if os.path.isdir(os.path.join(store_path, name)))
+
+
+def write_partition(partition_path, datetimes, df):
+    os.makedirs(partition_path, exist_ok=True)
+    np.save(os.path.join(partition_path, INDEX_NAME + '.npy'), datetimes)
+    for col_name in df.columns:
+        if col_name == 'Region':
+            continue
+        values = df[col_name].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(partition_path, col_name + '.npy'), values)
+
+
+def read_prices(store_path, regions=None, first_date=None, last_date=None):
+    # Read a prices dataframe from the store, only loading the partitions of the given regions and date range
+    # Example call: read_prices('data/spot_prices', ['SE1'], '2019-03-25', '2019-03-30')
+    #
+    # --- Arguments description --
+    # regions is a list of regions (or a single region), all the regions are read if it is not provided.
+    # first_date and last_date are both included, like when slicing a dataframe with dates.
+    # The dataframe is returned with the same structure as the one saved, sorted by datetime.
+    with open(os.path.join(store_path, COLUMNS_FILE_NAME)) as f:
+        columns = json.load(f)['columns']
+    if regions is None:
+        regions = list_regions(store_path)
+    elif isinstance(regions, str):
+        regions = [regions]
+    first_date = None if first_date is None else pd.to_datetime(first_date).to_datetime64().astype('datetime64[ns]')
+    last_date = None if last_date is None else pd.to_datetime(last_date).to_datetime64().astype('datetime64[ns]')
+
+    frames = []
+    for region in regions:
+        region_path = os.path.join(store_path, region)
+        if not os.path.isdir(region_path):
+            continue
+        for month in sorted(os.listdir(region_path)):
+            month_start = np.datetime64(month, 'M')
+            if first_date is not None and month_start < first_date.astype('datetime64[M]'):
+                continue
+            if last_date is not None and month_start > last_date.astype('datetime64[M]'):
+                continue
+            frame = read_partition(os.path.join(region_path, month), columns, region, first_date, last_date)
+            if len(frame):
+                frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name=INDEX_NAME))
+    df = pd.concat(frames)
+    return df.iloc[np.argsort(df.index.values, kind='stable')]
+
+
+def read_partition(partition_path, columns, region, first_date=None, last_date=None):
+    datetimes = np.load(os.path.join(partition_path, INDEX_NAME + '.npy'), mmap_mode='r')
+    start = 0 if first_date is None else np.searchsorted(datetimes, first_date, side='left')
+    end = len(datetimes) if last_date is None else np.searchsorted(datetimes, last_date, side='right')
+    data = {}
+    for col_name in columns:
+        if col_name == 'Region':
+            data[col_name] = np.full(end - start, region, dtype=object)
+        else:
+            values = np.load(os.path.join(partition_path, col_name + '.npy'), mmap_mode='r')[start:end]
+            data[col_name] = values.astype(object) if values.dtype.kind == 'U' else np.array(values)
+    return pd.DataFrame(data, columns=columns,
+                        index=pd.DatetimeIndex(np.array(datetimes[start:end]), name=INDEX_NAME))
+
+
+def market_arrays(spot_prices, regulation_prices):
+    # Join the spot and regulation prices of one region into market arrays
+    # The first row is kept for duplicated datetimes, the prices are matched on the datetime and the unit.
+    # The arrays have the shorter time unit of the two series (e.g. 15-minute imbalance prices with hourly spot
+    # prices): each row of the other series is matched with all the rows of the period it covers.
+    spot_prices = spot_prices[~spot_prices.index.duplicated(keep='first')]
+    regulation_prices = regulation_prices[~regulation_prices.index.duplicated(keep='first')]
+    spot_resolution = time_resolution(spot_prices.index)
+    regulation_resolution = time_resolution(regulation_prices.index)
+    if spot_resolution == regulation_resolution:
+        data = spot_prices.merge(regulation_prices, left_on=[INDEX_NAME, 'Region', 'Unit'],
+                                 right_on=[INDEX_NAME, 'Region', 'Unit'])
+    else:
+        if spot_resolution < regulation_resolution:
+            short, long, long_resolution = spot_prices, regulation_prices, regulation_resolution
+        else:
+            short, long, long_resolution = regulation_prices, spot_prices, spot_resolution
+        short = short.iloc[np.argsort(short.index.values, kind='stable')].reset_index()
+        long = long.iloc[np.argsort(long.index.values, kind='stable')].reset_index()
+        data = pd.merge_asof(short, long.drop(columns='Region').assign(Matched=True), on=INDEX_NAME, by='Unit',
+                             tolerance=long_resolution - pd.Timedelta(1, unit='ns'))
+        data = data[data['Matched'].notna()].drop(columns='Matched').set_index(INDEX_NAME)
+    data = data.iloc[np.argsort(data.index.values, kind='stable')]
+    # The dominating direction is missing (nan) for some hours
+    directions = data['Dominating_direction'].to_numpy(dtype=np.float64)
+    known_direction = ~np.isnan(directions)
+    arrays = {INDEX_NAME: pd.DatetimeIndex(data.index).values.astype('datetime64[ns]'),
+              'Unit': data['Unit'].to_numpy().astype(str),
+              'Spot_price': data['Spot_price'].to_numpy(dtype=np.float64),
+              'Upregulation_price': data['Upregulation_price'].to_numpy(dtype=np.float64),
+              'Downregulation_price': data['Downregulation_price'].to_numpy(dtype=np.float64),
+              'Dominating_direction': np.where(known_direction, directions, 0).astype(np.int8)}
+    arrays['Validity'] = (np.where(arrays['Spot_price'] != -1, VALID_SPOT_PRICE, 0)
+                          | np.where(arrays['Upregulation_price'] != -1, VALID_UPREGULATION_PRICE, 0)
+                          | np.where(arrays['Downregulation_price'] != -1, VALID_DOWNREGULATION_PRICE, 0)
+                          | np.where(known_direction, VALID_DOMINATING_DIRECTION, 0)).astype(np.uint8)
+    return arrays
+
+
+def write_market_arrays(market_path, region, arrays):
+    region_path = os.path.join(market_path, region)
+    os.makedirs(region_path, exist_ok=True)
+    for col_name in [INDEX_NAME] + MARKET_COLUMNS:
+        np.save(os.path.join(region_path, col_name + '.npy'), arrays[col_name])
+
+
+def read_market_arrays(market_path, region, first_date=None, last_date=None):
+    # Memory-map the market arrays of a region, sliced to the range of dates (both included) with a binary search
+    region_path = os.path.join(market_path, region)
+    if not os.path.isdir(region_path):
+        return {col_name: np.empty(0) for col_name in [INDEX_NAME] + MARKET_COLUMNS}
+    datetimes = np.load(os.path.join(region_path, INDEX_NAME + '.npy'), mmap_mode='r')
+    start = 0 if first_date is None else np.searchsorted(
+        datetimes, pd.to_datetime(first_date).to_datetime64().astype('datetime64[ns]'), side='left')
+    end = len(datetimes) if last_date is None else np.searchsorted(
+        datetimes, pd.to_datetime(last_date).to_datetime64().astype('datetime64[ns]'), side='right')
+    arrays = {INDEX_NAME: datetimes[start:end]}
+    for col_name in MARKET_COLUMNS:
+        arrays[col_name] = np.load(os.path.join(region_path, col_name + '.npy'), mmap_mode='r')[start:end]
+    return arrays
+
+
+def read_market_sources(market_path):
+    # Versions of the price stores the market arrays were built from
+    # (None if they were never built, or built in another format)
+    try:
+        with open(os.path.join(market_path, MARKET_FILE_NAME)) as f:
+            market = json.load(f)
+    except FileNotFoundError:
+        return None
+    if market.get('format') != MARKET_FORMAT:
+        return None
+    return market['sources']
+
+
+def write_market_sources(market_path, sources):
+    os.makedirs(market_path, exist_ok=True)
+    with open(os.path.join(market_path, MARKET_FILE_NAME), 'w') as f:
+        json.dump({'format': MARKET_FORMAT, 'sources': sources}, f)
+
+
+def migrate_csv_to_store(csv_path, store_path):
+    # One-time migration of a prices CSV file (as written by the previous versions of get_data) to the store
+    # Example call: migrate_csv_to_store('data/spot_prices.csv', 'data/spot_prices')
+    df = pd.read_csv(csv_path, parse_dates=True, index_col=0)
+    df.index.name = INDEX_NAME
+    write_prices(df, store_path)
+    return df
@@ -0,0 +1,108 @@
+import time
+import tracemalloc
+from collections import OrderedDict
+import pandas as pd
+
+
+class StageProfiler:
+    # Wall time, rows processed and peak allocated memory of the stages of backtesting_function,
+    # aggregated over all the calls made with the same profiler
+    # Example call:
+    # profiler = StageProfiler()
+    # for bidding_curve in bidding_curves:
+    #     backtesting_function('SE1', bidding_curve, production, update=False, profiler=profiler)
+    # print(profiler.report())
+    #
+    # --- Arguments description --
+    # Set memory to False to only measure the times (tracing the allocations slows down the stages).
+    # callback is called at the end of every stage with the stage name, its wall time in seconds,
+    # its number of rows and its peak memory in bytes (None when not measured).
+
+    def __init__(self, memory=True, callback=None):
+        self.memory = memory
+        self.callback = callback
+        self.stats = OrderedDict()
+
+    def stage(self, name):
+        return ProfiledStage(self, name)
+
+    def record(self, name, seconds, rows, peak_memory):
+        stats = self.stats.setdefault(name, {'calls': 0, 'seconds': 0., 'rows': 0, 'peak_memory': None})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['rows'] += rows or 0
+        if peak_memory is not None:
+            stats['peak_memory'] = max(stats['peak_memory'] or 0, peak_memory)
+        if self.callback is not None:
+            self.callback(name, seconds, rows, peak_memory)
+
+    def report(self):
+        # One row per stage with the number of calls, the total and mean times, the total number of rows,
+        # the throughput and the largest peak memory of a call
+        report = pd.DataFrame([dict(stats, stage=name) for name, stats in self.stats.items()],
+                              columns=['stage', 'calls', 'seconds', 'rows', 'peak_memory'])
+        report = report.set_index('stage')
+        report['mean_seconds'] = report['seconds'] / report['calls']
+        report['rows_per_second'] = report['rows'] / report['seconds']
+        report['peak_memory_mb'] = report['peak_memory'].astype(float) / 2 ** 20
+        return report[['calls', 'seconds', 'mean_seconds', 'rows', 'rows_per_second', 'peak_memory_mb']]
+
+    def reset(self):
+        self.stats.clear()
+
+
+class ProfiledStage:
+    # Context manager measuring one stage, the code of the stage sets its rows attribute
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        self.started_tracing = False
+        if self.profiler.memory:
+            if tracemalloc.is_tracing():
+                # Already traced by the caller, only the peak of the stage is wanted
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                self.started_tracing = True
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        peak_memory = None
+        if self.profiler.memory:
+            current, peak_memory = tracemalloc.get_traced_memory()
+            if self.started_tracing:
+                tracemalloc.stop()
+        if exc_type is None:
+            self.profiler.record(self.name, seconds, self.rows, peak_memory)
+        return False
+
+
+class NullStage:
+    # Stage used without profiler, so that the instrumented code runs unchanged
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_stage = NullStage()
+
+
+def profile_stage(profiler, name):
+    # Context manager measuring a stage with the profiler, doing nothing when the profiler is None
+    # Example call:
+    # with profile_stage(profiler, 'clearing') as stage:
+    #     ...
+    #     stage.rows = len(data)
+    if profiler is None:
+        return null_stage
+    return profiler.stage(name)
@@ -0,0 +1,220 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from get_data import update_prices, update_market_arrays
+from backtesting import backtesting_function
+from wrapper_Ilias import wrapper_bidding_curve_Ilias, wrapper_production_Ilias
+
+# Command-line runner backtesting every forecast archive of a directory in every region of a config file
+# Example call: python run_backtests.py config.json --workers 8
+#
+# The config is a JSON file like:
+# {
+#     "regions": ["SE1", "SE2", "SE3", "SE4"],
+#     "forecast_directory": "forecasts",
+#     "pattern": "*.npz",
+#     "start": "2017-01-01",
+#     "starts": {"day_1_2017.npz": "2017-01-01"},
+#     "one_price": false,
+#     "optimal": true,
+#     "producer": true,
+#     "convert_to_utc": false,
+#     "update": true,
+#     "output": "results"
+# }
+# starts gives the datetime of the first hour of some archives (start is used for the others), the other settlement
+# options have the same meaning as in backtesting_function, and forecast_directory is relative to the config file.
+#
+# The prices are updated once (if update is true) and the market arrays built again if they are stale, then the jobs
+# (one per region and archive) run on a pool of worker processes reading the memory-mapped market arrays.
+# Every job writes its results to <output>/parts/<job>.npz as soon as it is done, with its settlement options (start,
+# one_price, optimal, producer and convert_to_utc), so that a run interrupted can be resumed: the jobs with results
+# of the same options are skipped (unless --no-resume is given), the others are run again.
+# At the end, all the results are gathered in one columnar file, <output>/results.npz (or results.arrow with
+# --format arrow, requires pyarrow), with Region, Forecast, Datetime and the columns of backtesting_function,
+# and the timings of every job are written to <output>/timings.json.
+
+default_config = {'pattern': '*.npz', 'start': '2017-01-01', 'starts': {}, 'one_price': False, 'optimal': False,
+                  'producer': True, 'convert_to_utc': False, 'update': True, 'output': 'results'}
+
+
+def read_config(config_file):
+    with open(config_file) as f:
+        config = dict(default_config, **json.load(f))
+    if 'regions' not in config or 'forecast_directory' not in config:
+        raise ValueError('The config must give the regions and the forecast_directory')
+    config_directory = os.path.dirname(os.path.abspath(config_file))
+    config['forecast_directory'] = os.path.join(config_directory, config['forecast_directory'])
+    config['output'] = os.path.join(config_directory, config['output'])
+    return config
+
+
+def list_jobs(config):
+    # One job per region and forecast archive, in a stable order
+    file_names = sorted(glob.glob(os.path.join(config['forecast_directory'], config['pattern'])))
+    jobs = []
+    for region in config['regions']:
+        for file_name in file_names:
+            forecast = os.path.splitext(os.path.basename(file_name))[0]
+            jobs.append({'job': region + '_' + forecast,
+                         'region': region,
+                         'forecast': forecast,
+                         'file_name': file_name,
+                         'start': config['starts'].get(os.path.basename(file_name), config['start']),
+                         'one_price': config['one_price'],
+                         'optimal': config['optimal'],
+                         'producer': config['producer'],
+                         'convert_to_utc': config['convert_to_utc'],
+                         'part_file_name': os.path.join(config['output'], 'parts', region + '_' + forecast + '.npz')})
+    for job in jobs:
+        job['options'] = job_options(job)
+    return jobs
+
+
+def job_options(job):
+    # Fingerprint of the settlement options of a job, saved with its results
+    return json.dumps({key: job[key] for key in ['start', 'one_price', 'optimal', 'producer', 'convert_to_utc']},
+                      sort_keys=True)
+
+
+def part_options(part_file_name):
+    # Settlement options saved in a part file, None if it does not exist or was written without them
+    if not os.path.exists(part_file_name):
+        return None
+    with np.load(part_file_name) as part:
+        return str(part['Options']) if 'Options' in part.files else None
+
+
+def run_job(job):
+    # Backtest one archive in one region and save the results of the job, returns its timings
+    # Runs in the worker processes, the prices being already up to date.
+    started = time.perf_counter()
+    bidding_curve = wrapper_bidding_curve_Ilias(job['file_name'], job['start'], mmap=True)
+    production = wrapper_production_Ilias(job['file_name'], job['start'], mmap=True)
+    if job['convert_to_utc']:
+        bidding_curve = bidding_curve.tz_localize('UTC')
+        production = production.tz_localize('UTC')
+    loaded = time.perf_counter()
+    result = backtesting_function(job['region'], bidding_curve, production, job['one_price'], job['optimal'],
+                                  False, job['producer'], job['convert_to_utc'])
+    backtested = time.perf_counter()
+
+    datetimes = pd.DatetimeIndex(result.index)
+    if datetimes.tz is not None:
+        datetimes = datetimes.tz_convert('UTC').tz_localize(None)
+    columns = {'Datetime': datetimes.values.astype('datetime64[ns]')}
+    columns.update({col_name: result[col_name].to_numpy(dtype=np.float64) for col_name in result.columns})
+    columns['Options'] = np.array(job['options'])
+    os.makedirs(os.path.dirname(job['part_file_name']), exist_ok=True)
+    # Written under another name first, so that a part file always holds complete results
+    temporary_file_name = job['part_file_name'][:-4] + '.tmp.npz'
+    np.savez(temporary_file_name, **columns)
+    os.replace(temporary_file_name, job['part_file_name'])
+    return {'rows': len(result),
+            'load_seconds': loaded - started,
+            'backtest_seconds': backtested - loaded,
+            'seconds': time.perf_counter() - started}
+
+
+def gather_results(jobs, output, output_format='npz'):
+    # Concatenate the part files of the jobs in one columnar file, and return its name
+    # A ValueError is raised if a part was computed with other settlement options or has other columns than the others.
+    columns = {'Region': [], 'Forecast': []}
+    part_columns = None
+    for job in jobs:
+        if not os.path.exists(job['part_file_name']):
+            continue
+        with np.load(job['part_file_name']) as part:
+            if 'Options' not in part.files or str(part['Options']) != job['options']:
+                raise ValueError('The results of {0} were computed with other settlement options'.format(job['job']))
+            col_names = [col_name for col_name in part.files if col_name != 'Options']
+            if part_columns is None:
+                part_columns = col_names
+            elif col_names != part_columns:
+                raise ValueError('The results of {0} have the columns {1} instead of {2}'.format(
+                    job['job'], ', '.join(col_names), ', '.join(part_columns)))
+            rows = len(part['Datetime'])
+            columns['Region'].append(np.full(rows, job['region']))
+            columns['Forecast'].append(np.full(rows, job['forecast']))
+            for col_name in col_names:
+                columns.setdefault(col_name, []).append(part[col_name])
+    columns = {col_name: np.concatenate(values) if values else np.empty(0) for col_name, values in columns.items()}
+
+    if output_format == 'arrow':
+        import pyarrow as pa
+        file_name = os.path.join(output, 'results.arrow')
+        table = pa.Table.from_arrays([pa.array(values) for values in columns.values()], names=list(columns))
+        with pa.OSFile(file_name, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        file_name = os.path.join(output, 'results.npz')
+        np.savez(file_name, **columns)
+    return file_name
+
+
+def run_backtests(config, workers=None, resume=True, output_format='npz'):
+    # Run all the jobs of a config (see the top of this file) and return their timings by job
+    jobs = list_jobs(config)
+    os.makedirs(config['output'], exist_ok=True)
+    timings_file_name = os.path.join(config['output'], 'timings.json')
+    timings = {}
+    if resume and os.path.exists(timings_file_name):
+        with open(timings_file_name) as f:
+            timings = json.load(f)
+    if not resume:
+        for job in jobs:
+            if os.path.exists(job['part_file_name']):
+                os.remove(job['part_file_name'])
+    # The jobs without results, or with results of other settlement options, are run
+    pending_jobs = [job for job in jobs if part_options(job['part_file_name']) != job['options']]
+    print('{0} jobs, {1} to run.'.format(len(jobs), len(pending_jobs)))
+
+    # The prices are prepared once here, the workers only read the market arrays
+    if config['update'] and pending_jobs:
+        update_prices(stream=True)
+    update_market_arrays()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job): job for job in pending_jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                timings[job['job']] = dict(future.result(), status='done')
+                print('{0}: {1:.2f} s'.format(job['job'], timings[job['job']]['seconds']))
+            except Exception:
+                timings[job['job']] = {'status': 'failed', 'error': traceback.format_exc()}
+                print('{0}: failed'.format(job['job']))
+            # Saved after every job, so that the timings survive an interruption
+            with open(timings_file_name, 'w') as f:
+                json.dump(timings, f, indent=2)
+
+    print('Results written to {0}'.format(gather_results(jobs, config['output'], output_format)))
+    return timings
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Backtest a directory of forecast archives in several regions.')
+    parser.add_argument('config', help='JSON config file')
+    parser.add_argument('--workers', type=int, help='number of worker processes (number of cores by default)')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='run all the jobs again instead of skipping the ones with results')
+    parser.add_argument('--format', dest='output_format', choices=['npz', 'arrow'], default='npz',
+                        help='format of the results file')
+    args = parser.parse_args(args)
+
+    timings = run_backtests(read_config(args.config), args.workers, args.resume, args.output_format)
+    failed = [job for job, timing in timings.items() if timing['status'] == 'failed']
+    if failed:
+        print('Failed jobs: {0}'.format(', '.join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
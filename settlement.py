@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def imbalance_errors(production, volume):
+    # Positive and negative errors between the actual production and the cleared volume
+    e_plus = np.maximum(production - volume, 0)
+    e_minus = np.minimum(production - volume, 0)
+    return e_plus, e_minus
+
+
+def imbalance_cost(spot_price, upregulation_price, downregulation_price, dominating_direction,
+                   e_plus, e_minus, one_price=False):
+    # Compute the imbalance cost of every hour with the same equations as backtesting_function
+    # Example call: cost = imbalance_cost(spot, up, down, direction, e_plus, e_minus, one_price=True)
+    #
+    # --- Arguments description --
+    # All the arguments are numpy arrays broadcast against each other, so that the errors of several
+    # scenarios with shape (scenarios, hours) can be settled against the same prices with shape (hours,).
+    # Hours with a dominating direction other than -1, 0 or 1 get a nan cost.
+    if one_price:
+        # If one price system
+        conditions = [dominating_direction == 1, dominating_direction == -1, dominating_direction == 0]
+        choices = [upregulation_price * e_plus + upregulation_price * e_minus,
+                   downregulation_price * e_plus + downregulation_price * e_minus,
+                   spot_price * e_plus + spot_price * e_minus]
+    else:
+        # If two prices system
+        conditions = [(dominating_direction == 1) | (dominating_direction == -1), dominating_direction == 0]
+        choices = [downregulation_price * e_plus + upregulation_price * e_minus,
+                   spot_price * e_plus + spot_price * e_minus]
+    return np.select(conditions, choices, default=np.nan)
@@ -25,3 +25,21 @@ colnames = map(Symbol, result.columns);
 results = DataFrame(Any[collect(result[c]) for c in colnames], colnames);
 
 totalProfit = sum(results.Profit);
+
+
+# Same backtest from plain arrays, without converting the inputs and the results to pandas dataframes
+
+loader4 = machinery.SourceFileLoader("arrow_api","arrow_api.py");
+arrowapi = loader4.load_module("arrow_api");
+
+np = pyimport("numpy");
+price_cols = [c for c in bidding_curve.columns if occursin("price", c)];
+volume_cols = [c for c in bidding_curve.columns if occursin("volume", c)];
+bid_prices = convert(Matrix{Float64}, bidding_curve[price_cols].values);
+bid_volumes = convert(Matrix{Float64}, bidding_curve[volume_cols].values);
+datetimes = bidding_curve.index.values;
+production_values = convert(Vector{Float64}, production["Production"].values);
+
+arrays = arrowapi.backtesting_arrays("SE1", datetimes, bid_prices, bid_volumes, production_values, false, false, false);
+
+totalProfitArrays = sum(arrays["Profit"]);
@@ -0,0 +1,266 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import get_data
+import backtesting
+from benchmark import synthetic_price_rows, synthetic_bidding_curve, synthetic_production, FakeCursor, \
+    use_data_directory
+from price_store import write_prices, append_prices
+from clearing import bidding_curve_arrays
+from arrow_api import backtesting_arrays
+from optimization import evaluation_market
+from test_clearing import reference_volumes
+from test_get_data import reference_prices
+
+# End-to-end comparison of backtesting_function with the first version of the function (price parsing, merge,
+# clearing and settlement row by row), on synthetic prices covering both daylight saving time changes of 2019
+
+
+@pytest.fixture(scope='module')
+def price_rows():
+    spot_rows, reg_rows = synthetic_price_rows(225, ['SE1', 'SE2'], start='2019-03-24')
+    # A few invalid prices, which are removed from the market data
+    spot_rows[4][5][3] = -1
+    reg_rows[30][4][7] = -1
+    reg_rows[61][4][12] = -1
+    # Hours of SE2 without a dominating direction, which have a nan imbalance cost
+    assert reg_rows[35][6] == reg_rows[1295][6] == 'DD' and reg_rows[35][0] == reg_rows[1295][0] == 'SE2'
+    reg_rows[35][4][9] = np.nan
+    reg_rows[1295][4][17] = np.nan
+    return spot_rows, reg_rows
+
+
+def write_store(directory, spot_rows, reg_rows):
+    # Price store built from the synthetic rows in a data directory, returns the paths of the store it replaces
+    names = ['spot_prices_data_path', 'regulation_prices_data_path', 'spot_prices_store_path',
+             'regulation_prices_store_path', 'market_store_path']
+    paths = {name: getattr(get_data, name) for name in names}
+    use_data_directory(directory)
+    write_prices(pd.concat(list(get_data.spot_price_batches(FakeCursor(spot_rows)))), get_data.spot_prices_store_path)
+    write_prices(pd.concat(list(get_data.reg_price_batches(FakeCursor(reg_rows)))),
+                 get_data.regulation_prices_store_path)
+    get_data.build_market_arrays()
+    backtesting.clear_market_data_cache()
+    backtesting.clear_cleared_volumes_cache()
+    return paths
+
+
+def restore_store(paths):
+    for name, path in paths.items():
+        setattr(get_data, name, path)
+    backtesting.clear_market_data_cache()
+    backtesting.clear_cleared_volumes_cache()
+
+
+@pytest.fixture(scope='module')
+def price_store(price_rows, tmp_path_factory):
+    paths = write_store(str(tmp_path_factory.mktemp('data')), *price_rows)
+    yield
+    restore_store(paths)
+
+
+@pytest.fixture(scope='module')
+def reference_price_frames(price_rows):
+    return reference_prices(*price_rows)
+
+
+def reference_cet_to_utc(df):
+    # Row by row conversion of the first version of utils.cet_to_utc: the rows of the missing hour of March are
+    # removed, and the single rows of the repeated hour of October are duplicated for both UTC hours
+    rows = []
+    datetimes = []
+    for datetime, row in zip(df.index, df.itertuples(index=False)):
+        try:
+            datetimes.append(datetime.tz_localize('CET').tz_convert('UTC'))
+            rows.append(row)
+        except Exception:
+            if datetime.month == 10:
+                datetimes += [(datetime - pd.Timedelta(hours=2)).tz_localize('UTC'),
+                              (datetime - pd.Timedelta(hours=1)).tz_localize('UTC')]
+                rows += [row, row]
+    return pd.DataFrame(rows, columns=df.columns, index=pd.DatetimeIndex(datetimes, name='Datetime'))
+
+
+def reference_backtest(reference_price_frames, region, bidding_curve, production, one_price, producer, convert_to_utc):
+    # Merge, clearing and settlement of the first version of backtesting_function
+    spot_prices, regulation_prices = reference_price_frames
+    # The rows are converted one by one, so the other regions can be removed first
+    spot_prices = spot_prices[spot_prices['Region'] == region]
+    regulation_prices = regulation_prices[regulation_prices['Region'] == region]
+    if convert_to_utc:
+        spot_prices = reference_cet_to_utc(spot_prices)
+        regulation_prices = reference_cet_to_utc(regulation_prices)
+    spot_prices = spot_prices[spot_prices.index.isin(bidding_curve.index)]
+    regulation_prices = regulation_prices[regulation_prices.index.isin(bidding_curve.index)]
+    regulation_prices = regulation_prices[~regulation_prices.index.duplicated(keep='first')]
+    spot_prices = spot_prices[~spot_prices.index.duplicated(keep='first')]
+    data = spot_prices.reset_index().merge(regulation_prices.reset_index(), on=['Datetime', 'Region', 'Unit']) \
+        .set_index('Datetime')
+    data = data[(data['Spot_price'] != -1) & (data['Upregulation_price'] != -1) & (data['Downregulation_price'] != -1)]
+
+    data['Volume'] = reference_volumes(data['Spot_price'].to_numpy(), bidding_curve.loc[data.index], producer)
+    data = data.merge(production, left_index=True, right_index=True)
+    data['E+'] = np.maximum(data['Production'] - data['Volume'], 0)
+    data['E-'] = np.minimum(data['Production'] - data['Volume'], 0)
+    if one_price:
+        up_prices = {1: 'Upregulation_price', -1: 'Downregulation_price', 0: 'Spot_price'}
+        down_prices = up_prices
+    else:
+        up_prices = {1: 'Upregulation_price', -1: 'Upregulation_price', 0: 'Spot_price'}
+        down_prices = {1: 'Downregulation_price', -1: 'Downregulation_price', 0: 'Spot_price'}
+    for direction in (1, -1, 0):
+        rows = data['Dominating_direction'] == direction
+        data.loc[rows, 'Imbalance_cost'] = data[down_prices[direction]] * data['E+'] \
+                                           + data[up_prices[direction]] * data['E-']
+    data['Profit'] = data['Spot_price'] * data['Volume'] + data['Imbalance_cost']
+    data['Profit_no_error'] = data['Production'] * data['Spot_price']
+    data['Optimization_ratio'] = data['Profit'] / data['Profit_no_error']
+    return data[['Imbalance_cost', 'Profit', 'Profit_no_error', 'Optimization_ratio']]
+
+
+@pytest.mark.parametrize('convert_to_utc', [False, True])
+@pytest.mark.parametrize('producer', [True, False])
+@pytest.mark.parametrize('one_price', [False, True])
+def test_backtesting_function_matches_reference(reference_price_frames, price_store, one_price, producer,
+                                                convert_to_utc):
+    # Two weeks around each daylight saving time change. The 25th price of the day of the October change is parsed
+    # as 0 am of the next day, which then has two rows of prices: the first version merged all their combinations
+    # and kept one depending on the sort order, so this hour (11 pm UTC) is left out.
+    index = pd.date_range('2019-03-25', '2019-04-07 23:00', freq='h') \
+        .append(pd.date_range('2019-10-21', '2019-11-03 23:00', freq='h')).rename('Datetime')
+    index = index.drop(pd.DatetimeIndex(['2019-10-27 23:00', '2019-10-28 00:00']))
+    bidding_curve = synthetic_bidding_curve(len(index), 5).set_index(index)
+    production = synthetic_production(len(index)).set_index(index)
+    if convert_to_utc:
+        bidding_curve = bidding_curve.tz_localize('UTC')
+        production = production.tz_localize('UTC')
+
+    result = backtesting.backtesting_function('SE2', bidding_curve, production, one_price, True, False, producer,
+                                              convert_to_utc)
+    expected = reference_backtest(reference_price_frames, 'SE2', bidding_curve, production, one_price, producer,
+                                  convert_to_utc)
+    assert len(result) > 600
+    assert result['Imbalance_cost'].isna().sum() == 2
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False, check_freq=False,
+                                  check_names=False)
+
+
+def test_memoized_volumes_match_cleared_volumes(price_store, tmp_path, monkeypatch):
+    index = pd.date_range('2019-04-01', '2019-04-14 23:00', freq='h', name='Datetime')
+    bidding_curve = synthetic_bidding_curve(len(index), 5).set_index(index)
+    data = backtesting.load_market_data('SE1', index, update=False)
+    expected = backtesting.cleared_volumes(data, bidding_curve)
+    monkeypatch.setattr(backtesting, 'cleared_volumes_cache_directory', str(tmp_path))
+    backtesting.clear_cleared_volumes_cache(disk=True)
+
+    np.testing.assert_array_equal(backtesting.cleared_volumes(data, bidding_curve, memoize=True), expected)
+    np.testing.assert_array_equal(backtesting.cleared_volumes(data, bidding_curve.copy(), memoize=True), expected)
+    shifted_curve = bidding_curve.copy()
+    shifted_curve.iloc[:, 0::2] += 5
+    assert not np.array_equal(backtesting.cleared_volumes(data, shifted_curve, memoize=True), expected)
+    assert backtesting.cleared_volumes_cache_info()['hits'] == 1
+    assert backtesting.cleared_volumes_cache_info()['misses'] == 2
+
+    # The volumes written to the disk cache are read back once the cache in memory is cleared
+    backtesting.clear_cleared_volumes_cache()
+    np.testing.assert_array_equal(backtesting.cleared_volumes(data, bidding_curve, memoize=True), expected)
+    assert backtesting.cleared_volumes_cache_info()['disk_hits'] == 1
+    assert sorted(os.path.splitext(name)[1] for name in os.listdir(str(tmp_path))) == ['.npy', '.npy']
+    backtesting.clear_cleared_volumes_cache(disk=True)
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.fixture
+def quarter_hour_price_store(tmp_path):
+    # Hourly spot prices with 15-minute regulation prices (different for each quarter), and 15-minute directions
+    spot_rows, reg_rows = synthetic_price_rows(14, ['SE1'], start='2019-04-01')
+    reg_rows = [row[:4] + ([price + (0 if row[6] == 'DD' else 0.25 * (i % 4))
+                            for i, price in enumerate(np.repeat(row[4], 4))],) + row[5:] for row in reg_rows]
+    paths = write_store(str(tmp_path), spot_rows, reg_rows)
+    yield
+    restore_store(paths)
+
+
+@pytest.mark.parametrize('entry_point', ['function', 'batch', 'parallel', 'settlements', 'arrays', 'evaluation'])
+def test_finer_prices_raise_in_every_entry_point(quarter_hour_price_store, entry_point):
+    # Settling hourly curves would only use the prices of the first quarter of every hour
+    index = pd.date_range('2019-04-02', '2019-04-10 23:00', freq='h', name='Datetime')
+    bidding_curve = synthetic_bidding_curve(len(index), 5).set_index(index)
+    production = synthetic_production(len(index)).set_index(index)
+    with pytest.raises(ValueError, match='shorter than'):
+        if entry_point == 'function':
+            backtesting.backtesting_function('SE1', bidding_curve, production, update=False)
+        elif entry_point == 'batch':
+            backtesting.backtesting_batch('SE1', bidding_curve, production, update=False)
+        elif entry_point == 'parallel':
+            backtesting.backtesting_parallel('SE1', bidding_curve, production, update=False, workers=1)
+        elif entry_point == 'settlements':
+            backtesting.backtesting_settlements('SE1', bidding_curve, production, update=False)
+        elif entry_point == 'arrays':
+            bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve)
+            backtesting_arrays('SE1', index.values, bid_prices, bid_volumes, production['Production'].to_numpy(),
+                               update=False)
+        else:
+            evaluation_market('SE1', production, production, update=False)
+
+
+def test_quarter_hour_curves_settle_alike_in_every_entry_point(quarter_hour_price_store):
+    index = pd.date_range('2019-04-02', '2019-04-10 23:45', freq='15min', name='Datetime')
+    bidding_curve = synthetic_bidding_curve(len(index), 5).set_index(index)
+    production = synthetic_production(len(index)).set_index(index)
+    expected = backtesting.backtesting_function('SE1', bidding_curve, production, optimal=True, update=False)
+    assert len(expected) == len(index)
+
+    batch = backtesting.backtesting_batch('SE1', bidding_curve, production, optimal=True, update=False)
+    pd.testing.assert_frame_equal(batch.loc[0], expected, check_freq=False, check_names=False)
+    parallel = backtesting.backtesting_parallel('SE1', bidding_curve, production, optimal=True, update=False,
+                                                workers=1)
+    pd.testing.assert_frame_equal(parallel.loc['SE1'], expected, check_freq=False, check_names=False)
+    settlements = backtesting.backtesting_settlements('SE1', bidding_curve, production, ['two_prices'], ['producer'],
+                                                      update=False)
+    pd.testing.assert_frame_equal(settlements['producer', 'two_prices'], expected, check_freq=False,
+                                  check_names=False)
+    bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve)
+    arrays = backtesting_arrays('SE1', index.values, bid_prices, bid_volumes, production['Production'].to_numpy(),
+                                optimal=True, update=False)
+    np.testing.assert_array_equal(arrays['Profit'], expected['Profit'].to_numpy())
+
+
+def test_walk_forward_windows_of_quarter_hour_curves(quarter_hour_price_store):
+    index = pd.date_range('2019-04-02', '2019-04-10 23:45', freq='15min', name='Datetime')
+    bidding_curve = synthetic_bidding_curve(len(index), 5).set_index(index)
+    production = synthetic_production(len(index)).set_index(index)
+    rolling, daily = backtesting.backtesting_walk_forward('SE1', bidding_curve, production, '2D', '1D', 'D',
+                                                          update=False)
+    result = backtesting.backtesting_function('SE1', bidding_curve, production, optimal=True, update=False)
+    assert daily['Window_end'].iloc[-1] == pd.Timestamp('2019-04-11')
+    assert daily['Periods'].tolist() == [96] * 9
+    assert rolling.index[-1] == pd.Timestamp('2019-04-09')
+    for start, window in rolling.iterrows():
+        rows = result[(result.index >= start) & (result.index < window['Window_end'])]
+        assert window['Periods'] == len(rows)
+        np.testing.assert_allclose(window['Profit'], rows['Profit'].sum())
+
+
+def test_store_writes_invalidate_market_data_cache(tmp_path):
+    spot_rows, reg_rows = synthetic_price_rows(20, ['SE1'], start='2019-04-01')
+    paths = write_store(str(tmp_path), spot_rows[:2 * 10], reg_rows[:3 * 10])
+    try:
+        index = pd.date_range('2019-04-05', '2019-04-15 23:00', freq='h', name='Datetime')
+        data = backtesting.load_market_data('SE1', index, update=False)
+        assert data.index.max() == pd.Timestamp('2019-04-10 23:00')
+        pd.testing.assert_frame_equal(backtesting.load_market_data('SE1', index, update=False), data)
+        assert backtesting.market_data_cache_info()['hits'] == 1
+
+        # New days written to the store (the market arrays are built again when they are loaded)
+        append_prices(pd.concat(list(get_data.spot_price_batches(FakeCursor(spot_rows[2 * 10:])))),
+                      get_data.spot_prices_store_path)
+        append_prices(pd.concat(list(get_data.reg_price_batches(FakeCursor(reg_rows[3 * 10:])))),
+                      get_data.regulation_prices_store_path)
+        data = backtesting.load_market_data('SE1', index, update=False)
+        assert backtesting.market_data_cache_info()['misses'] == 2
+        assert data.index.max() == pd.Timestamp('2019-04-15 23:00')
+        pd.testing.assert_frame_equal(data, backtesting.load_market_data('SE1', index, update=False, cache=False))
+    finally:
+        restore_store(paths)
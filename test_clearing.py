@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+from clearing import RaggedCurve, bidding_curve_arrays, clear_bidding_curve, from_ragged, clear_ragged_curve
+
+
+def reference_volumes(spot_prices, bidding_curve, producer=True):
+    # Row by row clearing of the first version of backtesting_function, the reference of clear_bidding_curve
+    # (the first version raised StopIteration when the spot price was equal to the last bid price of a producer,
+    # the last bid volume is used instead)
+    price_cols = [col_name for col_name in bidding_curve.columns if 'price' in col_name]
+    vol_cols = [col_name for col_name in bidding_curve.columns if 'volume' in col_name]
+    volumes = []
+    for spot_price, (_, row) in zip(spot_prices, bidding_curve.iterrows()):
+        if producer:
+            # If spot price is above biggest bidding price, assign biggest bidding volume
+            if spot_price > row[price_cols[-1]]:
+                volumes.append(row[vol_cols[-1]])
+                continue
+            i = next((price_cols.index(col_name) for col_name in price_cols if spot_price < row[col_name]), None)
+            if i is None:
+                volumes.append(row[vol_cols[-1]])
+            # If spot price is below smallest bidding price, assign 0 volume
+            elif i == 0:
+                volumes.append(0)
+            else:
+                volumes.append(row[vol_cols[i]] - ((row[price_cols[i]] - spot_price) /
+                                                   (row[price_cols[i]] - row[price_cols[i - 1]])) *
+                               (row[vol_cols[i]] - row[vol_cols[i - 1]]))
+        else:
+            # If spot price is under smallest bidding price, assign biggest bidding volume
+            if spot_price < row[price_cols[0]]:
+                volumes.append(row[vol_cols[0]])
+                continue
+            i = next((price_cols.index(col_name) for col_name in price_cols if spot_price < row[col_name]), -1)
+            # If spot price is above biggest bidding price, assign 0 volume
+            if i == -1:
+                volumes.append(0)
+            else:
+                volumes.append(row[vol_cols[i]] - ((row[price_cols[i - 1]] - spot_price) /
+                                                   (row[price_cols[i - 1]] - row[price_cols[i]])) *
+                               (row[vol_cols[i]] - row[vol_cols[i - 1]]))
+    return np.array(volumes, dtype=np.float64)
+
+
+def random_ragged_curve(hours=2000, max_points=6, seed=0, min_points=1):
+    # Increasing curves of min_points to max_points points, with prices on a coarse grid hit by the spot prices
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(min_points, max_points + 1, hours)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    prices = np.concatenate([np.sort(rng.choice(np.arange(0., 60., 5.), n, replace=False)) for n in lengths])
+    volumes = np.concatenate([np.cumsum(rng.uniform(0., 10., n)) for n in lengths])
+    index = pd.date_range('2019-01-01', periods=hours, freq='h', name='Datetime')
+    spot_prices = rng.choice(np.arange(-10., 70., 2.5), hours)
+    return RaggedCurve(index, offsets, prices, volumes), spot_prices
+
+
+def test_padded_curves_clear_like_ragged_curves():
+    ragged_curve, spot_prices = random_ragged_curve()
+    bid_prices, bid_volumes = bidding_curve_arrays(from_ragged(ragged_curve))
+    assert np.isnan(bid_prices).any()
+    for producer in (True, False):
+        np.testing.assert_array_equal(clear_bidding_curve(spot_prices, bid_prices, bid_volumes, producer),
+                                      clear_ragged_curve(spot_prices, ragged_curve, producer))
+
+
+def test_clearing_matches_reference_loop():
+    # Random curves with spot prices equal to bid prices (ties), below the first and above the last ones
+    ragged_curve, spot_prices = random_ragged_curve(hours=5000, max_points=6, seed=3, min_points=6)
+    bidding_curve = from_ragged(ragged_curve)
+    bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve)
+    assert np.isin(spot_prices, bid_prices).sum() > 100
+    for producer in (True, False):
+        np.testing.assert_array_equal(clear_bidding_curve(spot_prices, bid_prices, bid_volumes, producer),
+                                      reference_volumes(spot_prices, bidding_curve, producer))
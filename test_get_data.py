@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+from datetime import timedelta
+import pandas as pd
+import pytest
+import get_data
+from benchmark import synthetic_price_rows, FakeCursor, use_data_directory
+from price_store import write_prices, read_manifest
+
+
+def reference_prices(spot_rows, reg_rows):
+    # Spot and regulation prices parsed row by row like the first version of get_data, one row per price
+    spot_prices = pd.DataFrame([(query[0], query[1], pd.to_datetime(query[2]) + timedelta(hours=i), price)
+                                for query in spot_rows for i, price in enumerate(query[5])],
+                               columns=['Region', 'Unit', 'Datetime', 'Spot_price']).set_index('Datetime')
+    reg_prices = {}
+    for reg_code, col_name in (('RN', 'Downregulation_price'), ('RO', 'Upregulation_price'),
+                               ('DD', 'Dominating_direction')):
+        reg_prices[reg_code] = pd.DataFrame([(pd.to_datetime(query[1]) + timedelta(hours=i), query[0], price)
+                                             for query in reg_rows if query[6] == reg_code
+                                             for i, price in enumerate(query[4])],
+                                            columns=['Datetime', 'Region', col_name])
+    regulation_prices = reg_prices['RN'].merge(reg_prices['RO'], on=['Datetime', 'Region']) \
+        .merge(reg_prices['DD'], on=['Datetime', 'Region'])
+    regulation_prices['Unit'] = 'EUR'
+    regulation_prices = regulation_prices.set_index('Datetime')
+    return spot_prices.sort_index(kind='mergesort'), regulation_prices.sort_index(kind='mergesort')
+
+
+def sorted_rows(df, columns):
+    # Rows of a prices dataframe in a canonical order, to compare dataframes sorted differently
+    return df.reset_index()[columns].sort_values(columns[:3], kind='mergesort').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 10000])
+def test_price_batches_match_reference(batch_size):
+    # Days around the March daylight saving time change (23 hours), split over several batches
+    spot_rows, reg_rows = synthetic_price_rows(20, ['SE1', 'SE2', 'SE3'], start='2019-03-22')
+    expected_spot, expected_reg = reference_prices(spot_rows, reg_rows)
+
+    spot_prices = pd.concat(list(get_data.spot_price_batches(FakeCursor(spot_rows), batch_size)))
+    columns = ['Datetime', 'Region', 'Unit', 'Spot_price']
+    pd.testing.assert_frame_equal(sorted_rows(spot_prices, columns), sorted_rows(expected_spot, columns),
+                                  check_dtype=False)
+
+    regulation_prices = pd.concat(list(get_data.reg_price_batches(FakeCursor(reg_rows), batch_size)))
+    columns = ['Datetime', 'Region', 'Unit', 'Downregulation_price', 'Upregulation_price', 'Dominating_direction']
+    pd.testing.assert_frame_equal(sorted_rows(regulation_prices, columns), sorted_rows(expected_reg, columns),
+                                  check_dtype=False)
+
+
+class FakeConnection:
+    # Connection answering the queries of fetch_date_ranges and query_price_rows from rows in memory,
+    # like the regional_elspot and regional_regulating tables of the database
+    def __init__(self, tables):
+        self.tables = tables
+
+    def cursor(self, name=None):
+        return FakeQueryCursor(self.tables)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeQueryCursor(FakeCursor):
+    def __init__(self, tables):
+        super().__init__([])
+        self.tables = tables
+
+    def execute(self, query, parameters=None):
+        table_name = query.split(' from ')[1].split()[0].rstrip(';')
+        date_position = 2 if table_name == 'regional_elspot' else 1
+        rows = self.tables[table_name]
+        if query.startswith('select min(data_date)'):
+            dates = [row[date_position] for row in rows]
+            self.rows = [(min(dates), max(dates)) if dates else (None, None)]
+        else:
+            first_date, end_date = parameters
+            rows = [row for row in rows if first_date <= row[date_position] < end_date]
+            if 'reg_code IN' in query:
+                rows = [row for row in rows if row[6] in ('RO', 'RN', 'DD')]
+            self.rows = sorted(rows, key=lambda row: row[date_position])
+        self.position = 0
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_database(tmp_path, monkeypatch):
+    # Empty price stores in a temporary directory, and a database whose tables are set by the test
+    # (the paths of get_data are restored by monkeypatch after the test)
+    for name in ['spot_prices_data_path', 'regulation_prices_data_path', 'spot_prices_store_path',
+                 'regulation_prices_store_path', 'market_store_path']:
+        monkeypatch.setattr(get_data, name, getattr(get_data, name))
+    use_data_directory(str(tmp_path))
+    tables = {'regional_elspot': [], 'regional_regulating': []}
+
+    @contextmanager
+    def database_connection():
+        yield FakeConnection(tables)
+
+    monkeypatch.setattr(get_data, 'database_connection', database_connection)
+    return tables
+
+
+def unavailable_last_day(spot_rows, reg_rows):
+    # Rows of a database where the prices of the last day are not available yet (-1)
+    last_day = max(row[2] for row in spot_rows)
+    spot_rows = [row[:5] + ([-1.] * len(row[5]),) if row[2] == last_day else row for row in spot_rows]
+    reg_rows = [row[:4] + ([-1.] * len(row[4]),) + row[5:] if row[1] == last_day and row[6] != 'DD' else row
+                for row in reg_rows]
+    return spot_rows, reg_rows
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_incremental_updates_match_full_write(fake_database, stream):
+    spot_rows, reg_rows = synthetic_price_rows(40, ['SE1', 'SE2'], start='2019-03-10')
+    first_days = 25
+    # First update: 25 days, the last one without prices yet (removed from the store)
+    first_spot_rows, first_reg_rows = unavailable_last_day(spot_rows[:4 * first_days], reg_rows[:6 * first_days])
+    fake_database['regional_elspot'] = first_spot_rows
+    fake_database['regional_regulating'] = first_reg_rows
+    get_data.update_prices(stream=stream, batch_size=7, chunk_days=10)
+    assert get_data.load_spot_prices().index.max() == pd.Timestamp('2019-04-02 23:00')
+
+    # Second update: all the days, with the prices of the day which was not available
+    fake_database['regional_elspot'] = spot_rows
+    fake_database['regional_regulating'] = reg_rows
+    get_data.update_prices(stream=stream, batch_size=7, chunk_days=10)
+    spot_prices = get_data.load_spot_prices()
+    regulation_prices = get_data.load_regulation_prices()
+    assert read_manifest(get_data.spot_prices_store_path)['regions']['SE1']['rows'] == len(spot_prices) // 2
+
+    write_prices(pd.concat(list(get_data.spot_price_batches(FakeCursor(spot_rows)))), get_data.spot_prices_store_path)
+    write_prices(pd.concat(list(get_data.reg_price_batches(FakeCursor(reg_rows)))),
+                 get_data.regulation_prices_store_path)
+    pd.testing.assert_frame_equal(spot_prices, get_data.load_spot_prices())
+    pd.testing.assert_frame_equal(regulation_prices, get_data.load_regulation_prices())
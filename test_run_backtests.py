@@ -0,0 +1,57 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import run_backtests
+from benchmark import synthetic_price_rows, synthetic_npz
+from test_backtesting import write_store, restore_store
+
+
+@pytest.fixture
+def batch_run(tmp_path, monkeypatch):
+    # Config of two forecast archives in two regions, with the prices in a temporary store.
+    # The jobs run on threads, so that they use the store of the test whatever the start method of the processes.
+    paths = write_store(str(tmp_path / 'data'), *synthetic_price_rows(40, ['SE1', 'SE2']))
+    monkeypatch.setattr(run_backtests, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    os.makedirs(str(tmp_path / 'forecasts'))
+    for seed in range(2):
+        synthetic_npz(str(tmp_path / 'forecasts' / 'day_{0}.npz'.format(seed)), 24 * 30, 4, seed)
+    config_file = str(tmp_path / 'config.json')
+
+    def run(**options):
+        with open(config_file, 'w') as f:
+            json.dump(dict({'regions': ['SE1', 'SE2'], 'forecast_directory': 'forecasts', 'update': False}, **options), f)
+        assert run_backtests.main([config_file, '--workers', '2']) == 0
+        with np.load(str(tmp_path / 'results' / 'results.npz')) as results:
+            return {col_name: results[col_name] for col_name in results.files}
+
+    yield run, tmp_path / 'results'
+    restore_store(paths)
+
+
+def test_resume_reruns_the_parts_of_other_options(batch_run):
+    run, output = batch_run
+    run(optimal=False)
+    os.remove(str(output / 'parts' / 'SE2_day_1.npz'))
+    results = run(optimal=True, one_price=True)
+    assert len(set(len(values) for values in results.values())) == 1
+    assert 'Optimization_ratio' in results
+
+    # Same results as a run from scratch
+    os.remove(str(output / 'results.npz'))
+    for file_name in os.listdir(str(output / 'parts')):
+        os.remove(str(output / 'parts' / file_name))
+    expected = run(optimal=True, one_price=True)
+    assert sorted(results) == sorted(expected)
+    for col_name in expected:
+        np.testing.assert_array_equal(results[col_name], expected[col_name])
+
+
+def test_gather_refuses_parts_of_other_options(batch_run):
+    run, output = batch_run
+    run(optimal=True)
+    config = run_backtests.read_config(str(output.parent / 'config.json'))
+    jobs = run_backtests.list_jobs(dict(config, one_price=True))
+    with pytest.raises(ValueError, match='other settlement options'):
+        run_backtests.gather_results(jobs, str(output))
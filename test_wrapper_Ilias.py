@@ -0,0 +1,28 @@
+import numpy as np
+from clearing import bidding_curve_arrays, clear_bidding_curve, clear_ragged_curve
+from wrapper_Ilias import wrapper_bidding_curve_Ilias, wrapper_production_Ilias
+
+
+def write_archive(file_name, lengths, seed=0):
+    # Forecast archive with one curve of the given number of points per hour
+    rng = np.random.RandomState(seed)
+    arrays = {'bidcurves' + str(i + 1): np.column_stack([np.sort(rng.choice(np.arange(0., 60., 5.), n, replace=False)),
+                                                         np.cumsum(rng.uniform(0., 10., n))])
+              for i, n in enumerate(lengths)}
+    arrays['actualgen'] = rng.uniform(0., 20., len(lengths)).reshape(-1, 24)
+    np.savez(file_name, **arrays)
+
+
+def test_curves_of_different_lengths_clear_like_ragged_curves(tmp_path):
+    file_name = str(tmp_path / 'archive.npz')
+    write_archive(file_name, np.random.RandomState(1).randint(1, 7, 48))
+    bidding_curve = wrapper_bidding_curve_Ilias(file_name, '2019-01-01')
+    ragged_curve = wrapper_bidding_curve_Ilias(file_name, '2019-01-01', ragged=True)
+    assert len(bidding_curve) == len(wrapper_production_Ilias(file_name, '2019-01-01')) == 48
+    assert (bidding_curve.index == ragged_curve.index).all()
+
+    spot_prices = np.random.RandomState(2).choice(np.arange(-10., 70., 2.5), 48)
+    bid_prices, bid_volumes = bidding_curve_arrays(bidding_curve)
+    for producer in (True, False):
+        np.testing.assert_array_equal(clear_bidding_curve(spot_prices, bid_prices, bid_volumes, producer),
+                                      clear_ragged_curve(spot_prices, ragged_curve, producer))
@@ -1,30 +1,108 @@
+import zipfile
 import numpy as np
 import pandas as pd
+from clearing import RaggedCurve
 
 
-def wrapper_bidding_curve_Ilias(file_name):
-    bidding_curve = np.load(file_name)
-    bidding_curves = {}
-    for x in bidding_curve:
-        if 'bidcurves' in x:
-            bidding_curves[x.split('s')[1]] = bidding_curve[x]
-    df = pd.DataFrame()
-    for time in range(24):
-        line_dic = {}
-        for i, element in enumerate(bidding_curve['bidcurves' + str(time + 1)]):
-            line_dic['bid_price_' + str(i+1)] = element[0]
-            line_dic['bid_volume_' + str(i+1)] = element[1]
-        one_time_df = pd.DataFrame(line_dic, index=[pd.to_datetime('2017-1-1 ' + str(time) + ':00:00')])
-        df = df.append(one_time_df)
-    df.index.name = 'Datetime'
-    return df
-
-def wrapper_production_Ilias(file_name):
-    bidding_curve = np.load(file_name)
-    production = bidding_curve['actualgen']
-    df = pd.DataFrame()
-
-    for i, value in enumerate(production[0]):
-        df = df.append(pd.DataFrame({'Production': value},index=[pd.to_datetime('2017-1-1 ' + str(i) + ':00:00')]))
-    df.index.name = ('Datetime')
-    return df
\ No newline at end of file
+def wrapper_bidding_curve_Ilias(file_name, start='2017-01-01', days=None, hours=None, mmap=False, ragged=False,
+                                resolution='h'):
+    # Load the bidding curves of a npz forecast archive as a bidding curve dataframe (see backtesting_function)
+    # Example call: wrapper_bidding_curve_Ilias('day_1_2017.npz')
+    #
+    # --- Arguments description --
+    # The archive contains one array per hour called bidcurves1, bidcurves2, ... with one (price, volume) row per point.
+    # start is the datetime of the first hour, and days or hours the number of hours to load
+    # (all the hours of the archive by default).
+    # resolution is the market time unit of the arrays (e.g. '15min' when there is one array per quarter hour).
+    # Set mmap to True to memory-map the arrays instead of reading them (only for uncompressed archives).
+    # Curves with fewer points than the others are padded with nan, unless ragged is True: a clearing.RaggedCurve
+    # with the actual points of every hour is then returned instead of a dataframe.
+    curve_names = sorted((name for name in npz_names(file_name) if name.startswith('bidcurves')),
+                         key=lambda name: int(name[9:]))
+    curve_names = curve_names[:number_of_hours(len(curve_names), days, hours, resolution)]
+    arrays = load_npz_arrays(file_name, curve_names, mmap)
+    if ragged:
+        points = np.concatenate([np.asarray(arrays[name], dtype=np.float64).reshape(-1, 2) for name in curve_names]) \
+            if curve_names else np.empty((0, 2))
+        offsets = np.concatenate([[0], np.cumsum([arrays[name].shape[0] for name in curve_names])]).astype(np.int64)
+        return RaggedCurve(hourly_index(start, len(curve_names), resolution), offsets, points[:, 0], points[:, 1])
+
+    n_points = max((arrays[name].shape[0] for name in curve_names), default=0)
+    curves = np.full((len(curve_names), n_points, 2), np.nan)
+    for i, name in enumerate(curve_names):
+        curves[i, :arrays[name].shape[0]] = arrays[name]
+    # Interleave the points as bid_price_1, bid_volume_1, bid_price_2, ...
+    columns = [col_name for i in range(n_points) for col_name in ('bid_price_' + str(i + 1), 'bid_volume_' + str(i + 1))]
+    return pd.DataFrame(curves.reshape(len(curve_names), 2 * n_points), columns=columns,
+                        index=hourly_index(start, len(curve_names), resolution))
+
+
+def wrapper_production_Ilias(file_name, start='2017-01-01', days=None, hours=None, mmap=False, resolution='h'):
+    # Load the actual production of a npz forecast archive as a production dataframe (see backtesting_function)
+    # Example call: wrapper_production_Ilias('day_1_2017.npz')
+    #
+    # --- Arguments description --
+    # The archive contains an actualgen array with one row per day (or a single row) of values per market time unit.
+    # The other arguments have the same meaning as in wrapper_bidding_curve_Ilias.
+    production = load_npz_arrays(file_name, ['actualgen'], mmap)['actualgen'].reshape(-1)
+    production = production[:number_of_hours(len(production), days, hours, resolution)]
+    return pd.DataFrame({'Production': np.asarray(production, dtype=np.float64)},
+                        index=hourly_index(start, len(production), resolution))
+
+
+def number_of_hours(available_periods, days=None, hours=None, resolution='h'):
+    # Number of periods of the given resolution to load for the requested days or hours
+    if hours is None and days is None:
+        return available_periods
+    periods_per_hour = pd.Timedelta(hours=1) / pd.Timedelta(pd.tseries.frequencies.to_offset(resolution))
+    requested_periods = int(round((hours if hours is not None else 24 * days) * periods_per_hour))
+    if requested_periods > available_periods:
+        raise ValueError('Requested {0} periods but the archive only contains {1}'.format(requested_periods,
+                                                                                     available_periods))
+    return requested_periods
+
+
+def hourly_index(start, periods, resolution='h'):
+    return pd.DatetimeIndex(pd.date_range(pd.to_datetime(start), periods=periods, freq=resolution), name='Datetime')
+
+
+def npz_names(file_name):
+    # Names of the arrays of a npz archive, without loading them
+    with zipfile.ZipFile(file_name) as archive:
+        return [name[:-4] if name.endswith('.npy') else name for name in archive.namelist()]
+
+
+def load_npz_arrays(file_name, names=None, mmap=False):
+    # Read the arrays of a npz archive (only the given names if provided) as a dict
+    # With mmap, the arrays stored without compression are views on a memory map of the archive file
+    if not mmap:
+        with np.load(file_name) as archive:
+            return {name: archive[name] for name in (archive.files if names is None else names)}
+    names = None if names is None else set(names)
+    file_map = np.memmap(file_name, dtype=np.uint8, mode='r')
+    arrays = {}
+    with zipfile.ZipFile(file_name) as archive, open(file_name, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if names is not None and name not in names:
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # The local file header is 30 bytes long, followed by the file name and the extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=file_map, offset=f.tell(),
+                                      order='F' if fortran_order else 'C')
+    return arrays